@@ -0,0 +1,143 @@
+"""
+Offline benchmarks for the resolve pipeline.
+
+Each stage is timed separately against the recorded fixtures in
+bench/fixtures, with HTTP requests going to a local StubServer:
+
+    get_sersol_response  urllib2 request, through the stub as a proxy, and parse
+    client.get_response  the same with a pooled Link360Client
+    convert              Link360JSON(doc).convert() on a parsed document
+    lazy_first_url       the first url from a LazySersolData view
+    resolved             Resolved(data)
+    openurl_pairs        Resolved.openurl_pairs() on a new Resolved
+
+    python bench/run.py --iterations 500 --latency 5 --error-rate 0.01
+"""
+import argparse
+import os
+import sys
+import urllib2
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lxml import etree
+from py360link import (LazySersolData, Link360Client, Link360JSON, Resolved,
+                       get_sersol_response)
+from stub_server import FIXTURES, StubServer
+
+KEY = 'bench'
+
+def percentile(sorted_times, pct):
+    if not sorted_times:
+        return 0.0
+    k = int(round((len(sorted_times) - 1) * pct / 100.0))
+    return sorted_times[k]
+
+class Stats(object):
+    def __init__(self, name):
+        self.name = name
+        self.times = []
+        self.errors = 0
+
+    def report(self):
+        times = sorted(self.times)
+        total = sum(times)
+        ops = len(times) / total if total else 0.0
+        ms = lambda t: t * 1000.0
+        return '%-40s %6d %6d %10.1f %9.3f %9.3f %9.3f %9.3f' % (
+            self.name, len(times), self.errors, ops,
+            ms(total / len(times)) if times else 0.0,
+            ms(percentile(times, 50)), ms(percentile(times, 90)),
+            ms(percentile(times, 99)))
+
+HEADER = '%-40s %6s %6s %10s %9s %9s %9s %9s' % (
+    'benchmark', 'n', 'errors', 'ops/s', 'mean ms', 'p50 ms', 'p90 ms', 'p99 ms')
+
+def measure(name, fn, iterations, setup=None):
+    """
+    Time fn(arg) iterations times, where arg is the result of setup(), run
+    untimed before each call.
+    """
+    stats = Stats(name)
+    for i in range(iterations):
+        arg = setup() if setup is not None else None
+        start = timer()
+        try:
+            fn(arg)
+        except Exception:
+            stats.errors += 1
+            continue
+        stats.times.append(timer() - start)
+    return stats
+
+def run(fixtures, iterations, http_iterations, latency, jitter, error_rate):
+    results = []
+    stub = StubServer(latency=latency, jitter=jitter,
+                      error_rate=error_rate).start()
+    proxy = urllib2.build_opener(urllib2.ProxyHandler({'http': 'http://' + stub.host}))
+    urllib2.install_opener(proxy)
+    client = Link360Client(KEY, host=stub.host)
+    try:
+        for name in fixtures:
+            query = 'bench_fixture=%s' % name
+            results.append(measure(
+                'get_sersol_response:%s' % name,
+                lambda arg: get_sersol_response(query, KEY, 5),
+                http_iterations))
+            results.append(measure(
+                'client.get_response:%s' % name,
+                lambda arg: client.get_response(query),
+                http_iterations))
+            doc = etree.parse(os.path.join(FIXTURES, name + '.xml'))
+            results.append(measure(
+                'convert:%s' % name,
+                lambda arg: Link360JSON(doc).convert(),
+                iterations))
+            data = Link360JSON(doc).convert()
+            if 'diagnostics' in data or not data['results']:
+                continue
+            results.append(measure(
+                'lazy_first_url:%s' % name,
+                lambda arg: LazySersolData(doc)['results'][0]['linkGroups'][0]['url'],
+                iterations))
+            results.append(measure(
+                'resolved:%s' % name,
+                lambda arg: Resolved(data),
+                iterations))
+            results.append(measure(
+                'openurl_pairs:%s' % name,
+                lambda resolved: resolved.openurl_pairs(),
+                iterations,
+                setup=lambda: Resolved(data)))
+    finally:
+        client.close()
+        stub.stop()
+        urllib2.install_opener(None)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline py360link benchmarks.')
+    parser.add_argument('fixtures', nargs='*',
+                        help='fixture names (default all in bench/fixtures)')
+    parser.add_argument('-n', '--iterations', type=int, default=1000,
+                        help='iterations for in-process stages')
+    parser.add_argument('--http-iterations', type=int, default=200,
+                        help='iterations for stages that go through the stub server')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='stub server delay in ms')
+    parser.add_argument('--jitter', type=float, default=0,
+                        help='stub server delay variation in ms')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='fraction of stub server responses that are 503s')
+    args = parser.parse_args()
+    fixtures = args.fixtures or sorted(
+        f[:-4] for f in os.listdir(FIXTURES) if f.endswith('.xml'))
+    results = run(fixtures, args.iterations, args.http_iterations,
+                  args.latency, args.jitter, args.error_rate)
+    print HEADER
+    for stats in results:
+        print stats.report()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""
+Local HTTP server that replays recorded 360Link XML responses, for running
+benchmarks without network access or an API key.
+
+The response is chosen with a bench_fixture=<name> query parameter, naming
+a file in bench/fixtures without the .xml extension, or the server's
+default fixture.  Requests may use a plain path or, when the server is set
+up as an HTTP proxy, an absolute url.
+
+    python bench/stub_server.py --port 8360 --latency 80 --jitter 20 --error-rate 0.01
+"""
+import argparse
+import os
+import random
+import threading
+import time
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+def load_fixtures(path=FIXTURES):
+    fixtures = {}
+    for name in os.listdir(path):
+        if name.endswith('.xml'):
+            with open(os.path.join(path, name), 'rb') as f:
+                fixtures[name[:-4]] = f.read()
+    return fixtures
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    #Buffer the response so headers and body go out together, and don't
+    #let Nagle's algorithm hold back the last segment of large responses
+    #on kept-alive connections.
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        stub = self.server.stub
+        query = urlparse.parse_qs(urlparse.urlsplit(self.path).query)
+        name = query.get('bench_fixture', [stub.default_fixture])[0]
+        delay = stub.latency + random.uniform(-stub.jitter, stub.jitter)
+        if delay > 0:
+            time.sleep(delay / 1000.0)
+        stub.requests += 1
+        body = stub.fixtures.get(name)
+        if body is None:
+            status, body = 404, 'Unknown fixture %s\n' % name
+        elif random.random() < stub.error_rate:
+            stub.errors += 1
+            status, body = 503, 'Service Unavailable\n'
+        else:
+            status = 200
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml; charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class StubServer(object):
+    """
+    Serve fixtures on host:port.  latency and jitter are in milliseconds;
+    error_rate is the fraction of requests answered with a 503.  Use port
+    0 to pick a free port.
+    """
+    def __init__(self, host='127.0.0.1', port=0, latency=0, jitter=0,
+                 error_rate=0, default_fixture='single', fixtures=None):
+        self.fixtures = fixtures or load_fixtures()
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.default_fixture = default_fixture
+        self.requests = 0
+        self.errors = 0
+        self._server = _Server((host, port), _Handler)
+        self._server.stub = self
+        self._thread = None
+
+    @property
+    def host(self):
+        """host:port to use as the 360Link host."""
+        return '%s:%d' % self._server.server_address
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8360)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='mean response delay in ms')
+    parser.add_argument('--jitter', type=float, default=0,
+                        help='+/- random variation of the delay in ms')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='fraction of requests answered with a 503')
+    parser.add_argument('--fixture', default='single',
+                        help='fixture served when bench_fixture is not given')
+    args = parser.parse_args()
+    stub = StubServer(args.host, args.port, args.latency, args.jitter,
+                      args.error_rate, args.fixture)
+    print 'Serving %s on %s' % (', '.join(sorted(stub.fixtures)), stub.host)
+    try:
+        stub.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
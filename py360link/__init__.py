@@ -1 +1,11 @@
 from link360 import *
+from cache import CacheStats, LRUCache, SqliteCache
+from client import Link360Client
+from asyncclient import Future, Link360AsyncClient, get_sersol_data_async
+from batch import BatchResult, iter_resolve, resolve_many
+from model import Citation, HoldingData, LinkGroup, Result, SersolData, compact
+from metrics import MetricsCollector, Observer, set_observer
+from resilience import CircuitBreaker, HedgePolicy, RetryPolicy
+from ratelimit import BULK, INTERACTIVE, RateLimiter, limiter_for
+from holdings import HoldingsIndex
+from reprocess import ReprocessResult, iter_reprocess, iter_sources
@@ -0,0 +1,169 @@
+"""
+Non-blocking lookups.  Requests are queued and run on a fixed number of
+worker threads; callers get a Future back immediately and either wait on
+it or register a callback.
+"""
+import sys
+import threading
+import time
+import Queue
+
+from client import Link360Client
+from link360 import Link360Timeout, get_sersol_data
+
+class Future(object):
+    """
+    Result of a lookup that may not have finished yet.
+    """
+    def __init__(self, query):
+        self.query = query
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """
+        Wait for and return the sersol data, re-raising any error from the
+        lookup.  Raises Link360Timeout if it isn't finished within timeout
+        seconds.
+        """
+        if not self._done.wait(timeout):
+            raise Link360Timeout('Lookup not finished after %s seconds.' % timeout)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise Link360Timeout('Lookup not finished after %s seconds.' % timeout)
+        if self._exc_info is not None:
+            return self._exc_info[1]
+        return None
+
+    def add_done_callback(self, fn):
+        """
+        Call fn(future) when the lookup finishes, from the worker thread, or
+        right away if it already has.
+        """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _finish(self, result=None, exc_info=None):
+        with self._lock:
+            self._result = result
+            self._exc_info = exc_info
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                pass
+
+class Link360AsyncClient(object):
+    """
+    Run lookups for one key in the background.
+
+    concurrency is the number of lookups in flight at once; further
+    submissions wait in a queue.  timeout is the limit in seconds for each
+    HTTP request made by the Link360Client created for the lookups; a
+    client passed in keeps its own timeout.  queue_timeout, if set, fails
+    lookups that wait longer than that many seconds in the queue with
+    Link360Timeout.  Extra keyword arguments (e.g. cache, coalesce) are
+    passed to get_sersol_data.
+    """
+    def __init__(self, key, concurrency=10, timeout=5, client=None,
+                 queue_timeout=None, **kwargs):
+        self.key = key
+        self.concurrency = concurrency
+        self.queue_timeout = queue_timeout
+        self.client = client or Link360Client(key, timeout=timeout,
+                                              pool_size=concurrency)
+        self.kwargs = kwargs
+        self._queue = Queue.Queue()
+        self._workers = []
+        for i in range(concurrency):
+            worker = threading.Thread(target=self._work,
+                                      name='py360link-%s-%d' % (key, i))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, query, callback=None, queue_timeout=None, timeout=None):
+        """
+        Queue a lookup and return its Future.  callback, if given, is added
+        with Future.add_done_callback.  queue_timeout overrides the client's
+        for this lookup; pass False for no queue deadline.  timeout, if
+        given, is the HTTP request limit for this lookup in place of the
+        Link360Client's.
+        """
+        future = Future(query)
+        if callback is not None:
+            future.add_done_callback(callback)
+        if queue_timeout is None:
+            queue_timeout = self.queue_timeout
+        deadline = None
+        if queue_timeout is not None and queue_timeout is not False:
+            deadline = time.time() + queue_timeout
+        self._queue.put((future, deadline, timeout))
+        return future
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            future, deadline, timeout = item
+            if deadline is not None and time.time() > deadline:
+                try:
+                    raise Link360Timeout('Lookup timed out waiting in queue.')
+                except Link360Timeout:
+                    future._finish(exc_info=sys.exc_info())
+                continue
+            try:
+                client = self.client
+                if timeout is not None:
+                    client = client.with_timeout(timeout)
+                data = get_sersol_data(future.query, client=client,
+                                       **self.kwargs)
+            except Exception:
+                future._finish(exc_info=sys.exc_info())
+            else:
+                future._finish(result=data)
+
+    def close(self):
+        """
+        Stop the workers once queued lookups finish and close connections.
+        """
+        for worker in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self.client.close()
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_sersol_data_async(query, key=None, timeout=5, callback=None,
+                          concurrency=10):
+    """
+    Start get_sersol_data in the background and return a Future.  timeout
+    is the limit in seconds for the HTTP request.
+
+    Lookups share one Link360AsyncClient per key; concurrency only takes
+    effect when that client is first created.
+    """
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = Link360AsyncClient(
+                key, concurrency=concurrency, timeout=timeout)
+    return client.submit(query, callback=callback, timeout=timeout)
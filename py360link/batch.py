@@ -0,0 +1,104 @@
+"""
+Resolve many OpenURLs at once on a pool of worker threads.
+"""
+import Queue
+from collections import deque
+
+from asyncclient import Link360AsyncClient
+from link360 import Resolved
+
+class BatchResult(object):
+    """
+    Outcome of one query in a batch.  index is the query's position in the
+    input.  On success data and resolved are set; otherwise error holds the
+    exception, e.g. a Link360Exception for diagnostics or a socket timeout.
+    """
+    __slots__ = ('index', 'query', 'data', 'resolved', 'error')
+
+    def __init__(self, index, query, data=None, resolved=None, error=None):
+        self.index = index
+        self.query = query
+        self.data = data
+        self.resolved = resolved
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        if self.ok:
+            return '<BatchResult %d ok>' % self.index
+        return '<BatchResult %d %s>' % (self.index, self.error.__class__.__name__)
+
+def _result(index, future):
+    error = future.exception()
+    if error is not None:
+        return BatchResult(index, future.query, error=error)
+    data = future.result()
+    try:
+        resolved = Resolved(data)
+    except Exception, e:
+        return BatchResult(index, future.query, data=data, error=e)
+    return BatchResult(index, future.query, data=data, resolved=resolved)
+
+def iter_resolve(queries, key=None, workers=8, ordered=True, timeout=5,
+                 client=None, **kwargs):
+    """
+    Resolve queries, an iterable of OpenURL query strings, yielding a
+    BatchResult for each.  Failures are recorded on the result rather than
+    raised.
+
+    At most workers lookups run at once and queries are read from the
+    iterable only as slots free up, so memory stays bounded for large or
+    streamed inputs.  With ordered=False results are yielded as they
+    complete instead of in input order.
+
+    Pass a Link360AsyncClient as client to share one across batches; its
+    concurrency then takes the place of workers, and its queue_timeout
+    isn't applied since queries only wait in its queue while others are
+    running.  Otherwise one is created for the batch and other keyword
+    arguments (e.g. cache) are passed to it for get_sersol_data.
+    """
+    own_client = client is None
+    if own_client:
+        client = Link360AsyncClient(key, concurrency=workers, timeout=timeout,
+                                    **kwargs)
+    window = client.concurrency * 2
+    completed = Queue.Queue()
+    pending = deque()
+    queries = enumerate(queries)
+    try:
+        while True:
+            while len(pending) < window:
+                try:
+                    index, query = queries.next()
+                except StopIteration:
+                    break
+                if ordered:
+                    future = client.submit(query, queue_timeout=False)
+                else:
+                    future = client.submit(
+                        query, queue_timeout=False,
+                        callback=lambda f, i=index: completed.put((i, f)))
+                pending.append((index, future))
+            if not pending:
+                break
+            if ordered:
+                index, future = pending.popleft()
+            else:
+                index, future = completed.get()
+                pending.remove((index, future))
+            yield _result(index, future)
+    finally:
+        if own_client:
+            client.close()
+
+def resolve_many(queries, key=None, workers=8, ordered=True, timeout=5,
+                 **kwargs):
+    """
+    Resolve all queries and return a list of BatchResult objects, in input
+    order unless ordered=False.
+    """
+    return list(iter_resolve(queries, key=key, workers=workers,
+                             ordered=ordered, timeout=timeout, **kwargs))
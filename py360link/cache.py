@@ -0,0 +1,209 @@
+"""
+Caches for the dictionaries returned by get_sersol_data.
+
+Pass an instance as the cache argument to get_sersol_data.  Any object with
+get(key) and set(key, value) methods will work, where get returns None on
+a miss.
+"""
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from link360 import StaleEntry
+
+class CacheStats(object):
+    """
+    Hit, miss and eviction counts for a cache.  Entries dropped because
+    their TTL has passed are counted as evictions.
+    """
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.0
+        return float(self.hits) / total
+
+    def as_dict(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': self.hit_ratio,
+        }
+
+    def __repr__(self):
+        return '<CacheStats hits=%d misses=%d evictions=%d>' % (
+            self.hits, self.misses, self.evictions)
+
+class LRUCache(object):
+    """
+    Thread safe in-process least recently used cache.
+
+    maxsize is the number of entries kept.  ttl, in seconds, is how long an
+    entry is served before it is treated as a miss; None keeps entries until
+    they are pushed out.
+
+    Values are returned as stored, so callers share the same dictionary and
+    should not modify it.
+    """
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stats = CacheStats()
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                self.stats.misses += 1
+                return None
+            if expires is not None and expires < time.time():
+                self.stats.evictions += 1
+                self.stats.misses += 1
+                return None
+            #Re-insert to mark as most recently used.
+            self._data[key] = (expires, value)
+            self.stats.hits += 1
+            return value
+
+    def set(self, key, value):
+        expires = None
+        if self.ttl is not None:
+            expires = time.time() + self.ttl
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expires, value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.stats.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+class SqliteCache(object):
+    """
+    Persistent cache stored in a local sqlite database.  Values are stored
+    as JSON, so strings come back as unicode, unless a codec such as
+    py360link.codec is given.  Entries the codec rejects as stale are
+    removed and counted as misses.
+
+    ttl is in seconds; None keeps entries indefinitely.  When maxsize is set
+    the oldest entries are removed once the table grows beyond it.
+    """
+    def __init__(self, path, ttl=None, maxsize=None, codec=None):
+        self.path = path
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.codec = codec
+        self.stats = CacheStats()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS sersol_cache '
+                '(key TEXT PRIMARY KEY, stored REAL, value TEXT)')
+            self._conn.execute(
+                'CREATE INDEX IF NOT EXISTS sersol_cache_stored '
+                'ON sersol_cache (stored)')
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT stored, value FROM sersol_cache WHERE key = ?',
+                (key,)).fetchone()
+            if row is None:
+                self.stats.misses += 1
+                return None
+            stored, value = row
+            if self.ttl is not None and stored + self.ttl < time.time():
+                with self._conn:
+                    self._conn.execute(
+                        'DELETE FROM sersol_cache WHERE key = ?', (key,))
+                self.stats.evictions += 1
+                self.stats.misses += 1
+                return None
+            if self.codec is None:
+                self.stats.hits += 1
+                return json.loads(value)
+            if isinstance(value, buffer):
+                value = str(value)
+            try:
+                data = self.codec.loads(value)
+            except StaleEntry:
+                with self._conn:
+                    self._conn.execute(
+                        'DELETE FROM sersol_cache WHERE key = ?', (key,))
+                self.stats.evictions += 1
+                self.stats.misses += 1
+                return None
+            self.stats.hits += 1
+        return data
+
+    def set(self, key, value):
+        if self.codec is None:
+            value = json.dumps(value, separators=(',', ':'))
+        else:
+            value = buffer(self.codec.dumps(value))
+        with self._lock:
+            with self._conn:
+                self._conn.execute(
+                    'INSERT OR REPLACE INTO sersol_cache (key, stored, value) '
+                    'VALUES (?, ?, ?)', (key, time.time(), value))
+                if self.maxsize is not None:
+                    cur = self._conn.execute(
+                        'DELETE FROM sersol_cache WHERE key IN '
+                        '(SELECT key FROM sersol_cache ORDER BY stored DESC '
+                        'LIMIT -1 OFFSET ?)', (self.maxsize,))
+                    self.stats.evictions += max(cur.rowcount, 0)
+
+    def delete(self, key):
+        with self._lock:
+            with self._conn:
+                self._conn.execute(
+                    'DELETE FROM sersol_cache WHERE key = ?', (key,))
+
+    def purge_expired(self):
+        """
+        Remove all entries older than the ttl.  Returns the number removed.
+        """
+        if self.ttl is None:
+            return 0
+        with self._lock:
+            with self._conn:
+                cur = self._conn.execute(
+                    'DELETE FROM sersol_cache WHERE stored < ?',
+                    (time.time() - self.ttl,))
+            removed = max(cur.rowcount, 0)
+            self.stats.evictions += removed
+        return removed
+
+    def clear(self):
+        with self._lock:
+            with self._conn:
+                self._conn.execute('DELETE FROM sersol_cache')
+
+    def close(self):
+        self._conn.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute(
+                'SELECT COUNT(*) FROM sersol_cache').fetchone()[0]
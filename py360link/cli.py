@@ -0,0 +1,181 @@
+"""
+Command line bulk resolver.
+
+Reads OpenURL query strings, one per line, from a file or stdin and writes
+a JSON record per line as each lookup completes:
+
+    {"line": 12, "query": "...", "data": {...}, "openurl": "...",
+     "oclc_number": "...", "error": null}
+
+With --checkpoint, progress is saved periodically so an interrupted run can
+be restarted with the same arguments and skip lookups already written.  On
+restart the output is cut back to its size at the last save, dropping any
+records, or part of one, written after it, and those lookups are redone.
+"""
+import argparse
+import json
+import os
+import sys
+
+from batch import iter_resolve
+from cache import SqliteCache
+
+class Checkpoint(object):
+    """
+    Tracks which input lines are done.  Stores the first line not yet done
+    plus the few done lines after it, so its size is bounded by the number
+    of lookups in flight rather than the size of the input.  offset is the
+    size of the output file when the lines were done.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.next = 0
+        self.done = set()
+        self.offset = None
+        if path and os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            self.next = saved['next']
+            self.done = set(saved['done'])
+            self.offset = saved.get('offset')
+
+    @property
+    def resuming(self):
+        return self.next > 0 or bool(self.done)
+
+    def is_done(self, lineno):
+        return lineno < self.next or lineno in self.done
+
+    def mark(self, lineno):
+        self.done.add(lineno)
+        while self.next in self.done:
+            self.done.remove(self.next)
+            self.next += 1
+
+    def save(self):
+        if not self.path:
+            return
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'next': self.next, 'done': sorted(self.done),
+                       'offset': self.offset}, f)
+        os.rename(tmp, self.path)
+
+def record(result, lineno):
+    """
+    JSON serializable record for a BatchResult.
+    """
+    out = {
+        'line': lineno,
+        'query': result.query,
+        'data': result.data,
+        'openurl': None,
+        'oclc_number': None,
+        'error': None,
+    }
+    if result.resolved is not None:
+        out['openurl'] = result.resolved.openurl
+        out['oclc_number'] = result.resolved.oclc_number
+    if result.error is not None:
+        out['error'] = '%s: %s' % (result.error.__class__.__name__, result.error)
+    return out
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Resolve OpenURL queries with the 360Link XML API.')
+    parser.add_argument('input', nargs='?', default='-',
+                        help='file of OpenURL queries, one per line (default stdin)')
+    parser.add_argument('-o', '--output', default='-',
+                        help='JSONL output file (default stdout)')
+    parser.add_argument('-k', '--key', default=os.environ.get('SERSOL_KEY'),
+                        help='360Link XML API key (default $SERSOL_KEY)')
+    parser.add_argument('-w', '--workers', type=int, default=8,
+                        help='concurrent lookups (default 8)')
+    parser.add_argument('-t', '--timeout', type=float, default=5,
+                        help='per request timeout in seconds (default 5)')
+    parser.add_argument('-c', '--checkpoint',
+                        help='checkpoint file for resuming interrupted runs')
+    parser.add_argument('--checkpoint-every', type=int, default=1000,
+                        help='records between checkpoint saves (default 1000)')
+    parser.add_argument('--cache',
+                        help='sqlite file to cache responses in between runs')
+    args = parser.parse_args(argv)
+    if not args.key:
+        parser.error('a 360Link key is required, use --key or $SERSOL_KEY')
+    if args.checkpoint and args.output == '-':
+        parser.error('--checkpoint requires --output')
+    if args.checkpoint_every < 1:
+        parser.error('--checkpoint-every must be at least 1')
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    checkpoint = Checkpoint(args.checkpoint)
+    if args.input == '-':
+        infile = sys.stdin
+    else:
+        infile = open(args.input)
+    if args.output == '-':
+        outfile = sys.stdout
+    elif checkpoint.resuming:
+        outfile = open(args.output, 'r+')
+        if checkpoint.offset is None:
+            outfile.seek(0, os.SEEK_END)
+        else:
+            #Drop whatever was written after the last save, which may end
+            #part way through a record if the run was killed.
+            outfile.seek(checkpoint.offset)
+            outfile.truncate()
+    else:
+        outfile = open(args.output, 'w')
+    kwargs = {}
+    if args.cache:
+        kwargs['cache'] = SqliteCache(args.cache)
+
+    #Batch index -> input line number, for lookups in flight.
+    linenos = {}
+    def queries():
+        index = 0
+        for lineno, line in enumerate(infile):
+            if checkpoint.is_done(lineno):
+                continue
+            query = line.strip()
+            if not query:
+                checkpoint.mark(lineno)
+                continue
+            linenos[index] = lineno
+            index += 1
+            yield query
+
+    ok = failed = 0
+    try:
+        for result in iter_resolve(queries(), key=args.key,
+                                   workers=args.workers, ordered=False,
+                                   timeout=args.timeout, **kwargs):
+            lineno = linenos.pop(result.index)
+            outfile.write(json.dumps(record(result, lineno)) + '\n')
+            checkpoint.mark(lineno)
+            if result.ok:
+                ok += 1
+            else:
+                failed += 1
+            if (ok + failed) % args.checkpoint_every == 0:
+                #Output has to reach the file before the checkpoint says
+                #it's done.
+                outfile.flush()
+                checkpoint.offset = outfile.tell()
+                checkpoint.save()
+    finally:
+        outfile.flush()
+        if outfile is not sys.stdout:
+            checkpoint.offset = outfile.tell()
+        checkpoint.save()
+        if outfile is not sys.stdout:
+            outfile.close()
+        if infile is not sys.stdin:
+            infile.close()
+    sys.stderr.write('%d resolved, %d failed\n' % (ok, failed))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
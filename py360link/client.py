@@ -0,0 +1,236 @@
+"""
+Reusable 360Link XML API client with a pool of keep-alive connections.
+"""
+import copy
+import errno
+import httplib
+import socket
+import sys
+import threading
+import urllib2
+import Queue
+from io import BytesIO
+from timeit import default_timer as timer
+
+from lxml import etree
+
+from link360 import (Link360Exception, SERSOL_HOST, SERSOL_PATH,
+                     get_sersol_data)
+
+def _is_stale(error):
+    """
+    True for errors that mean the server had already closed a kept-alive
+    connection: an empty status line, or a reset or broken pipe before any
+    response arrived.  Timeouts are not, since the request may be running.
+    """
+    if isinstance(error, socket.timeout):
+        return False
+    if isinstance(error, httplib.BadStatusLine):
+        return True
+    return (isinstance(error, socket.error) and
+            error.errno in (errno.ECONNRESET, errno.EPIPE))
+
+class _Stale(Exception):
+    def __init__(self, exc_info):
+        Exception.__init__(self, str(exc_info[1]))
+        self.exc_info = exc_info
+
+class Link360Client(object):
+    """
+    Make requests to the 360Link XML API for a single key, reusing HTTP
+    connections between requests.
+
+    pool_size bounds the number of open connections; callers beyond that
+    wait for a free connection.  connect_timeout applies to opening a
+    connection and timeout to each request on it.  Both are in seconds.
+    host overrides the 360Link API host, e.g. to go through a proxy or to
+    a local test server, as "name" or "name:port".
+
+    retry, hedge and breaker take a RetryPolicy, HedgePolicy and
+    CircuitBreaker from py360link.resilience.  They are applied in that
+    order from the outside in: the breaker sees one outcome per fetch after
+    retries, and each retry may be hedged.
+
+    limiter is a py360link.ratelimit.RateLimiter, usually shared by all
+    clients for the key via limiter_for.  Every request attempt waits for a
+    slot from it at this client's priority.
+
+    A client is safe to share between threads.
+    """
+    def __init__(self, key, timeout=5, pool_size=4, connect_timeout=None,
+                 host=None, retry=None, hedge=None, breaker=None,
+                 limiter=None, priority=0):
+        if key is None:
+            raise Link360Exception('Serial Solutions 360Link XML API key is required.')
+        self.key = key
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout or timeout
+        self.pool_size = pool_size
+        self.host = host or SERSOL_HOST % key
+        self.base_path = SERSOL_PATH + '&'
+        self.retry = retry
+        self.hedge = hedge
+        self.breaker = breaker
+        self.limiter = limiter
+        self.priority = priority
+        self._idle = Queue.LifoQueue(maxsize=pool_size)
+        self._slots = threading.BoundedSemaphore(pool_size)
+
+    def _connect(self, trace=None):
+        conn = httplib.HTTPConnection(self.host, timeout=self.connect_timeout)
+        if trace is None:
+            conn.connect()
+        else:
+            with trace.time('connect'):
+                conn.connect()
+        conn.sock.settimeout(self.timeout)
+        return conn
+
+    def _send(self, conn, path):
+        """
+        Send the request and read the response headers, raising _Stale if
+        the connection turns out to have been closed by the server.
+        """
+        try:
+            conn.request('GET', path, headers={'Connection': 'keep-alive'})
+            return conn.getresponse()
+        except (httplib.HTTPException, socket.error), e:
+            if _is_stale(e):
+                raise _Stale(sys.exc_info())
+            raise
+
+    def _request(self, conn, path, trace=None):
+        if trace is None:
+            response = self._send(conn, path)
+            return response, response.read()
+        with trace.time('request'):
+            response = self._send(conn, path)
+        with trace.time('read'):
+            body = response.read()
+        return response, body
+
+    def fetch(self, query, trace=None):
+        """
+        Return the raw XML response body for a query.  Stage timings are
+        added to trace, a py360link.metrics.Trace, if given.
+        """
+        if self.breaker is not None:
+            return self.breaker.call(self._fetch_retrying, query, trace)
+        return self._fetch_retrying(query, trace)
+
+    def _fetch_retrying(self, query, trace):
+        if self.retry is not None:
+            return self.retry.call(self._fetch_hedged, query, trace)
+        return self._fetch_hedged(query, trace)
+
+    def _fetch_hedged(self, query, trace):
+        if self.hedge is None:
+            return self._fetch(query, trace)
+        #Attempts may run in parallel, so they're timed as a whole.
+        if trace is None:
+            return self.hedge.call(self._fetch, query)
+        with trace.time('request'):
+            return self.hedge.call(self._fetch, query)
+
+    def _fetch(self, query, trace=None):
+        if self.limiter is None:
+            return self._fetch_once(query, trace)
+        if trace is None:
+            self.limiter.acquire(self.priority)
+        else:
+            with trace.time('throttle'):
+                self.limiter.acquire(self.priority)
+        start = timer()
+        try:
+            body = self._fetch_once(query, trace)
+        except Exception, e:
+            self.limiter.release(timer() - start, e)
+            raise
+        self.limiter.release(timer() - start)
+        return body
+
+    def _fetch_once(self, query, trace=None):
+        path = self.base_path + query.lstrip('?')
+        self._slots.acquire()
+        try:
+            try:
+                conn = self._idle.get_nowait()
+                #It may have been opened by a view with another timeout.
+                conn.sock.settimeout(self.timeout)
+                reused = True
+            except Queue.Empty:
+                conn = self._connect(trace)
+                reused = False
+            try:
+                response, body = self._request(conn, path, trace)
+            except _Stale, stale:
+                conn.close()
+                if not reused:
+                    raise stale.exc_info[0], stale.exc_info[1], stale.exc_info[2]
+                #The server closed the idle connection before our request
+                #reached it; try once more on a fresh one.
+                conn = self._connect(trace)
+                try:
+                    response, body = self._request(conn, path, trace)
+                except _Stale, stale:
+                    conn.close()
+                    raise stale.exc_info[0], stale.exc_info[1], stale.exc_info[2]
+                except:
+                    conn.close()
+                    raise
+            except:
+                conn.close()
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                try:
+                    self._idle.put_nowait(conn)
+                except Queue.Full:
+                    conn.close()
+        finally:
+            self._slots.release()
+        if response.status != 200:
+            raise urllib2.HTTPError('http://' + self.host + path,
+                                    response.status, response.reason,
+                                    response.msg, None)
+        return body
+
+    def with_timeout(self, timeout):
+        """
+        A client sharing this one's connections, limiter and resilience
+        policies, with timeout in place of this one's request timeout.
+        """
+        if timeout == self.timeout:
+            return self
+        view = copy.copy(self)
+        view.timeout = timeout
+        return view
+
+    def open_response(self, query):
+        """
+        File-like object with the response body, e.g. for Link360Stream.
+        """
+        return BytesIO(self.fetch(query))
+
+    def get_response(self, query):
+        """
+        Get the response and parse it into an etree.
+        """
+        return etree.parse(self.open_response(query))
+
+    def get_data(self, query, **kwargs):
+        """
+        get_sersol_data using this client.
+        """
+        return get_sersol_data(query, client=self, **kwargs)
+
+    def close(self):
+        """
+        Close idle connections.
+        """
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except Queue.Empty:
+                break
@@ -0,0 +1,138 @@
+"""
+Compact binary encoding of get_sersol_data output for caches.
+
+Link groups, which make up most of a response, are stored as tuples of
+their values in a fixed order, so holdingData, providerName, url and the
+other link group keys aren't written for every group.  The remaining
+field names and repeated values such as provider and database names are
+interned, which marshal writes once per entry and shares again on load.
+
+Every entry starts with a header carrying SCHEMA_VERSION and the marshal
+format version, and loads raises StaleEntry for entries written with any
+other, so a cache can treat them as misses:
+
+    blob = codec.dumps(data)
+    codec.loads(blob) == data
+    resolved = codec.load_resolved(blob)
+
+Use with SqliteCache(path, codec=codec).  marshal isn't safe against
+maliciously built data, so only load entries this library wrote.
+"""
+import marshal
+import struct
+
+from link360 import Resolved, StaleEntry
+
+#Bump when the layout below changes.
+SCHEMA_VERSION = 1
+
+MAGIC = 'S3L'
+_HEADER = struct.Struct('>3sBB')
+HEADER = _HEADER.pack(MAGIC, SCHEMA_VERSION, marshal.version)
+
+#A link group fits the packed form when it has exactly these keys, and
+#its holdingData the required ones plus any of the dates.
+_LINK_GROUP_KEYS = frozenset(('type', 'holdingData', 'url'))
+_HOLDING_KEYS = frozenset(('providerId', 'providerName', 'databaseId',
+                           'databaseName', 'startDate', 'endDate'))
+
+def _intern(value):
+    if type(value) is str:
+        return intern(value)
+    return value
+
+def _pack_link_group(g):
+    """
+    Flatten a link group to (type, providerId, providerName, databaseId,
+    databaseName, startDate, endDate, url).  Groups that don't fit are
+    left as dictionaries.
+    """
+    h = g.get('holdingData')
+    url = g.get('url')
+    if (len(g) != 3 or not _LINK_GROUP_KEYS.issuperset(g) or
+            type(h) is not dict or type(url) is not dict or
+            not _HOLDING_KEYS.issuperset(h)):
+        return g
+    start = h.get('startDate')
+    end = h.get('endDate')
+    if len(h) != 4 + (start is not None) + (end is not None):
+        return g
+    return (_intern(g['type']), _intern(h['providerId']),
+            _intern(h['providerName']), _intern(h['databaseId']),
+            _intern(h['databaseName']), start, end,
+            dict((_intern(k), v) for k, v in url.iteritems()))
+
+def _unpack_link_group(g):
+    if type(g) is dict:
+        return g
+    holding = {
+        'providerId': g[1],
+        'providerName': g[2],
+        'databaseId': g[3],
+        'databaseName': g[4],
+    }
+    if g[5] is not None:
+        holding['startDate'] = g[5]
+    if g[6] is not None:
+        holding['endDate'] = g[6]
+    return {'type': g[0], 'holdingData': holding, 'url': g[7]}
+
+def _pack_data(data):
+    packed = dict(data)
+    results = []
+    for r in data.get('results') or ():
+        r = dict(r)
+        r['format'] = _intern(r.get('format'))
+        if r.get('linkGroups'):
+            r['linkGroups'] = [_pack_link_group(g) for g in r['linkGroups']]
+        results.append(r)
+    if 'results' in data:
+        packed['results'] = results
+    return packed
+
+def _unpack_data(data):
+    for r in data.get('results') or ():
+        if r.get('linkGroups'):
+            r['linkGroups'] = [_unpack_link_group(g) for g in r['linkGroups']]
+    return data
+
+def dumps(data):
+    """
+    Encode get_sersol_data output, a LazySersolData view or a compact
+    SersolData as a string.
+    """
+    if hasattr(data, 'materialize'):
+        data = data.materialize()
+    elif hasattr(data, 'to_dict'):
+        data = data.to_dict()
+    return HEADER + marshal.dumps(_pack_data(data), marshal.version)
+
+def check(s):
+    """
+    Raise StaleEntry unless s was written by dumps with the current schema
+    and marshal versions.
+    """
+    if not isinstance(s, str) or len(s) < _HEADER.size:
+        raise StaleEntry('Not an encoded 360Link cache entry.')
+    magic, schema, marshal_version = _HEADER.unpack_from(s)
+    if magic != MAGIC:
+        raise StaleEntry('Not an encoded 360Link cache entry.')
+    if schema != SCHEMA_VERSION or marshal_version != marshal.version:
+        raise StaleEntry('Cache entry has schema version %d, marshal version '
+                         '%d; expected %d, %d.' % (schema, marshal_version,
+                                                   SCHEMA_VERSION,
+                                                   marshal.version))
+
+def loads(s):
+    """
+    Decode a string from dumps back into the get_sersol_data dictionary.
+    Raises StaleEntry for entries from another schema version.
+    """
+    check(s)
+    return _unpack_data(marshal.loads(s[_HEADER.size:]))
+
+def load_resolved(s, observer=None):
+    """
+    Decode a string from dumps straight into a Resolved.
+    """
+    return Resolved(loads(s), observer=observer)
@@ -0,0 +1,259 @@
+"""
+Local index of journal holdings, built from resolved 360Link responses.
+
+The link groups 360Link returns for an article describe the library's
+holdings of the journal, though which ones come back can depend on the
+article's date or embargoes.  HoldingsIndex merges them across responses
+by provider and database, stores them by ISSN and eISSN and can answer
+later article-level lookups for the same journals without calling the API:
+
+    index = HoldingsIndex('holdings.db', key, max_age=7 * 24 * 3600)
+    data = index.get_sersol_data(query)
+    resolved = Resolved(data)
+
+Only the journal level and source urls are kept.  Article and issue urls
+point at a particular article, so answers from the index don't have them.
+"""
+import json
+import sqlite3
+import threading
+import time
+import urlparse
+
+from link360 import SERSOL_MAP, get_sersol_data, split_id
+
+#Link types that apply to the whole journal.
+JOURNAL_URL_TYPES = ('journal', 'source')
+
+#OpenURL keys to citation keys, the reverse of SERSOL_MAP['journal'], plus
+#the OpenURL 0.1 journal title.
+OPENURL_CITATION_MAP = dict((v, k) for k, v in SERSOL_MAP['journal'].items())
+OPENURL_CITATION_MAP['title'] = 'source'
+
+def _covers(holding, date):
+    """
+    True if the holding's normalized start and end dates include date,
+    which can be a year, year-month or full date.
+    """
+    if not date:
+        return True
+    start = holding.get('startDate')
+    end = holding.get('endDate')
+    #Compare on the precision of the date asked for.
+    if start and start[:len(date)] > date:
+        return False
+    if end and end[:len(date)] < date:
+        return False
+    return True
+
+def citation_from_query(query):
+    """
+    Build a citation dictionary, in the Link360JSON form, from the
+    citation fields of an OpenURL query.
+    """
+    citation = {}
+    for k, values in urlparse.parse_qs(query.lstrip('?')).items():
+        value = values[0].strip()
+        if not value:
+            continue
+        if k.startswith('rft.'):
+            k = k[4:]
+        if k in ('id', 'rft_id', 'doi', 'pmid'):
+            for v in values:
+                if k in ('doi', 'pmid'):
+                    v = '%s:%s' % (k, v)
+                scheme, ident = split_id(v.strip())
+                if scheme and ident:
+                    citation[scheme] = ident
+            continue
+        field = OPENURL_CITATION_MAP.get(k)
+        if field == 'issn':
+            citation['issn'] = {'print': value}
+        elif field == 'isbn':
+            citation['isbn'] = [value]
+        elif field and field not in citation:
+            citation[field] = value
+    return citation
+
+class HoldingsIndex(object):
+    """
+    Holdings for one 360Link key, stored in a sqlite database that may be
+    shared by several keys.  Journals, and link groups, not seen in a
+    response for max_age seconds are ignored; None keeps them indefinitely.
+    """
+    def __init__(self, path, key, max_age=None):
+        self.path = path
+        self.key = key
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS journals '
+                '(key TEXT, issn TEXT, source TEXT, library TEXT, '
+                'db_date TEXT, updated REAL, PRIMARY KEY (key, issn))')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS journal_link_groups '
+                '(key TEXT, issn TEXT, provider_id TEXT, database_id TEXT, '
+                'position INTEGER, start_date TEXT, end_date TEXT, '
+                'updated REAL, link_group TEXT, '
+                'PRIMARY KEY (key, issn, provider_id, database_id))')
+
+    def add(self, data):
+        """
+        Merge the link groups of each journal result in get_sersol_data
+        output into the index.  Returns the ISSNs updated.
+        """
+        if data.get('diagnostics'):
+            return []
+        library = json.dumps(data['echoedQuery']['library'])
+        now = time.time()
+        updated = []
+        with self._lock:
+            with self._conn:
+                for result in data['results']:
+                    if result['format'] != 'journal':
+                        continue
+                    citation = result['citation']
+                    issns = set(citation.get('issn', {}).values())
+                    if citation.get('eissn'):
+                        issns.add(citation['eissn'])
+                    groups = []
+                    for group in result['linkGroups']:
+                        urls = dict((t, u) for t, u in group['url'].items()
+                                    if t in JOURNAL_URL_TYPES)
+                        groups.append({'type': group['type'],
+                                       'holdingData': dict(group['holdingData']),
+                                       'url': urls})
+                    for issn in issns:
+                        if not issn:
+                            continue
+                        self._store(issn, citation.get('source'), library,
+                                    data.get('dbDate'), now, groups)
+                        updated.append(issn)
+        return updated
+
+    def _store(self, issn, source, library, db_date, now, groups):
+        self._conn.execute(
+            'INSERT OR REPLACE INTO journals VALUES (?, ?, ?, ?, ?, ?)',
+            (self.key, issn, source, library, db_date, now))
+        #Groups from earlier responses are kept; one seen again is
+        #replaced by its latest form.
+        self._conn.executemany(
+            'INSERT OR REPLACE INTO journal_link_groups '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [(self.key, issn, g['holdingData'].get('providerId') or '',
+              g['holdingData'].get('databaseId') or '', i,
+              g['holdingData'].get('startDate'),
+              g['holdingData'].get('endDate'), now, json.dumps(g))
+             for i, g in enumerate(groups)])
+
+    def _cutoff(self):
+        if self.max_age is None:
+            return None
+        return time.time() - self.max_age
+
+    def _journal(self, issn):
+        row = self._conn.execute(
+            'SELECT source, library, db_date, updated FROM journals '
+            'WHERE key = ? AND issn = ?', (self.key, issn)).fetchone()
+        if row is None:
+            return None
+        cutoff = self._cutoff()
+        if cutoff is not None and row[3] < cutoff:
+            return None
+        return row
+
+    def link_groups(self, issn, date=None):
+        """
+        Link groups covering the journal on date, or None if the journal
+        isn't in the index or its entry is too old.
+        """
+        with self._lock:
+            if self._journal(issn) is None:
+                return None
+            rows = self._conn.execute(
+                'SELECT link_group, updated FROM journal_link_groups '
+                'WHERE key = ? AND issn = ? ORDER BY position, provider_id, '
+                'database_id', (self.key, issn)).fetchall()
+        cutoff = self._cutoff()
+        groups = [json.loads(row[0]) for row in rows
+                  if cutoff is None or row[1] >= cutoff]
+        return [g for g in groups if _covers(g['holdingData'], date)]
+
+    def resolve(self, query):
+        """
+        Answer an article level query from the index, returning data in the
+        get_sersol_data form, or None if none of its ISSNs are indexed.
+        """
+        citation = citation_from_query(query)
+        issns = citation.get('issn', {}).values()
+        if citation.get('eissn'):
+            issns.append(citation['eissn'])
+        for issn in issns:
+            with self._lock:
+                journal = self._journal(issn)
+            if journal is None:
+                continue
+            groups = self.link_groups(issn, citation.get('date'))
+            if groups is None:
+                continue
+            source, library, db_date, updated = journal
+            if source and 'source' not in citation:
+                citation['source'] = source
+            with self._lock:
+                self.hits += 1
+            return {
+                'version': '1.0',
+                'echoedQuery': {
+                    'queryString': query.lstrip('?'),
+                    'timeStamp': None,
+                    'library': json.loads(library),
+                },
+                'dbDate': db_date,
+                'results': [{
+                    'format': 'journal',
+                    'citation': citation,
+                    'linkGroups': groups,
+                }],
+            }
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def get_sersol_data(self, query, **kwargs):
+        """
+        Answer from the index when possible, otherwise call get_sersol_data
+        with this index's key and add the response to the index.
+        """
+        data = self.resolve(query)
+        if data is not None:
+            return data
+        data = get_sersol_data(query, key=self.key, **kwargs)
+        self.add(data)
+        return data
+
+    def purge(self):
+        """
+        Remove journals and link groups older than max_age.  Returns the
+        number of journals removed.
+        """
+        cutoff = self._cutoff()
+        if cutoff is None:
+            return 0
+        with self._lock:
+            with self._conn:
+                #A journal is updated whenever its groups are, so this
+                #covers the groups of the journals removed below too.
+                self._conn.execute(
+                    'DELETE FROM journal_link_groups WHERE key = ? AND '
+                    'updated < ?', (self.key, cutoff))
+                cur = self._conn.execute(
+                    'DELETE FROM journals WHERE key = ? AND updated < ?',
+                    (self.key, cutoff))
+        return max(cur.rowcount, 0)
+
+    def close(self):
+        self._conn.close()
@@ -1,7 +1,14 @@
+import cgi
+import re
+import sys
+import threading
 import urllib
+from io import BytesIO
 from lxml import etree
 import urlparse
 
+from metrics import Trace, get_observer
+
 #Added to avoid the following errors:
 #Cannot convert lxml.etree._RotatingErrorLog to lxml.etree._BaseErrorLog
 class Logger(etree.PyErrorLog):
@@ -60,41 +67,555 @@ class Link360Exception(Exception):
         Exception.__init__(self, message)
         self.Errors = Errors
 
-def get_sersol_response(query, key, timeout):
+class Link360Timeout(Link360Exception):
     """
-    Get the SerSol API response and parse it into an etree.
+    Raised when a lookup doesn't complete within its time limit.
+    """
+
+class CircuitOpen(Link360Exception):
+    """
+    Raised instead of making a request while a CircuitBreaker is open.
+    """
+
+class StaleEntry(Link360Exception):
+    """
+    Raised when a cache entry was encoded with another schema version.
+    """
+
+#Parameters sent with every request.
+REQUIRED_URL_ELEMENTS = {
+    'version': '1.0',
+    'url_ver': 'Z39.88-2004',
+}
+SERSOL_HOST = '%s.openurl.xml.serialssolutions.com'
+SERSOL_PATH = '/openurlxml?' + urllib.urlencode(REQUIRED_URL_ELEMENTS)
+
+def sersol_url(query, key):
+    """
+    Full 360Link XML API url for a query.
     """
-    import urllib2
     if key is None:
         raise Link360Exception('Serial Solutions 360Link XML API key is required.')
-    
-    required_url_elements = {}
-    required_url_elements['version'] = '1.0'
-    required_url_elements['url_ver'] = 'Z39.88-2004'
-    #Go get the 360link response
     #Base 360Link url
-    base_url = "http://%s.openurl.xml.serialssolutions.com/openurlxml?" % key
-    base_url += urllib.urlencode(required_url_elements)
-    url = base_url + '&%s' % query.lstrip('?')
-    f = urllib2.urlopen(url, timeout=timeout)
+    return 'http://' + SERSOL_HOST % key + SERSOL_PATH + '&' + query.lstrip('?')
+
+def open_sersol_response(query, key, timeout):
+    """
+    Open the SerSol API response and return the file-like object without
+    parsing it.
+    """
+    import urllib2
+    url = sersol_url(query, key)
+    #Go get the 360link response
+    return urllib2.urlopen(url, timeout=timeout)
+
+def get_sersol_response(query, key, timeout):
+    """
+    Get the SerSol API response and parse it into an etree.
+    """
+    f = open_sersol_response(query, key, timeout)
     doc = etree.parse(f)
     return doc
 
-def get_sersol_data(query, key=None, timeout=5):
+#Query parameters that identify the referring system or are always sent,
+#rather than describing the citation.  Ignored when building query keys.
+NON_CITATION_PARAMS = ('rfr_id', 'sid', 'url_ver', 'version')
+#Parameters saying who is asking rather than for what, which can differ
+#between callers sharing one cached or coalesced response.
+CALLER_PARAMS = ('rfr_id', 'sid', 'rfe_dat')
+
+def split_id(value):
+    """
+    Split a doi:/pmid: identifier or its info: URI form into the scheme
+    and identifier, e.g. info:doi/10.1000/ABC -> ('doi', '10.1000/ABC').
+    Returns (None, value) for other values.
+    """
+    lower = value.lower()
+    for scheme in ('doi', 'pmid'):
+        for prefix in ('info:%s/' % scheme, '%s:' % scheme):
+            if lower.startswith(prefix):
+                return scheme, value[len(prefix):].strip()
+    return None, value
+
+def _canonical_id(value):
+    """
+    Normalize doi:/pmid: identifiers and their info: URI forms to the
+    info URI, e.g. doi:10.1000/ABC -> info:doi/10.1000/abc.  Returns None
+    for an empty identifier such as the id=doi: OCLC sends.
+    """
+    scheme, ident = split_id(value)
+    if scheme is None:
+        return value
+    if not ident:
+        return None
+    #DOIs are case insensitive.
+    if scheme == 'doi':
+        ident = ident.lower()
+    return 'info:%s/%s' % (scheme, ident)
+
+def canonicalize_query(query):
+    """
+    Reduce an OpenURL query string to a stable form so that requests for
+    the same citation map to the same key.  Parameter order, referrer ids
+    (rfr_id, sid) and the version parameters are ignored and the id=doi:,
+    id=pmid:, doi= and pmid= forms are folded into rft_id info URIs.
+
+    This is for keys only; the original query is what gets sent to 360Link.
+    """
+    pairs = set()
+    for k, values in urlparse.parse_qs(query.lstrip('?')).items():
+        if k in NON_CITATION_PARAMS:
+            continue
+        for v in values:
+            if isinstance(v, unicode):
+                v = v.encode('utf-8')
+            v = v.strip()
+            if k in ('id', 'rft_id'):
+                pair = ('rft_id', _canonical_id(v))
+            elif k in ('doi', 'pmid'):
+                pair = ('rft_id', _canonical_id('%s:%s' % (k, v)))
+            else:
+                pair = (k, v)
+            if pair[1]:
+                pairs.add(pair)
+    return urllib.urlencode(sorted(pairs))
+
+def cache_key(query, key):
+    """
+    Key used to store a query's data in a cache.
+    """
+    return '%s|%s' % (key, canonicalize_query(query))
+
+class SingleFlight(object):
+    """
+    Coalesce concurrent calls that share a key.  The first caller runs the
+    function; callers arriving while it is in flight wait for and share its
+    result, or its exception.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        #Number of calls served by another caller's request.
+        self.shared = 0
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.shared += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error[0], call.error[1], call.error[2]
+            return call.result
+        try:
+            call.result = fn(*args, **kwargs)
+        except Exception:
+            call.error = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+#Shared by get_sersol_data(..., coalesce=True).
+INFLIGHT = SingleFlight()
+
+def _traced_response(query, key, timeout, client, trace):
+    """
+    get_sersol_response, timing each stage in trace.
+    """
+    fetch = getattr(client, 'fetch', None)
+    if client is not None and fetch is None:
+        with trace.time('request'):
+            return client.get_response(query)
+    if client is not None:
+        body = fetch(query, trace=trace)
+    else:
+        with trace.time('request'):
+            f = open_sersol_response(query, key, timeout)
+        try:
+            with trace.time('read'):
+                body = f.read()
+        finally:
+            f.close()
+    trace.bytes = len(body)
+    with trace.time('parse'):
+        return etree.parse(BytesIO(body))
+
+def _convert(doc, lazy):
+    if lazy:
+        return LazySersolData(doc)
+    return Link360JSON(doc).convert()
+
+def _fetch_sersol_data(query, key, timeout, cache, ckey, client, trace, lazy):
+    if trace is not None:
+        doc = _traced_response(query, key, timeout, client, trace)
+        with trace.time('convert'):
+            data = _convert(doc, lazy)
+    else:
+        if client is not None:
+            doc = client.get_response(query)
+        else:
+            doc = get_sersol_response(query, key, timeout)
+        data = _convert(doc, lazy)
+    if cache is not None and 'diagnostics' not in data:
+        #Store plain data rather than a view holding the parsed tree.
+        cache.set(ckey, data.materialize() if lazy else data)
+    return data
+
+def get_sersol_data(query, key=None, timeout=5, cache=None, coalesce=False,
+                    client=None, observer=None, fallback=None, lazy=False,
+                    fallback_on=None):
     """
     Get and process the data from the API and store in Python dictionary.
     If you would like to cache the 360Link responses, this is data structure
     that you would like to cache.  
     
     Specify a timeout for the http request to 360Link.
+
+    Pass a cache, e.g. LRUCache or SqliteCache from py360link.cache, to
+    serve repeat queries without calling the API.  Responses with
+    diagnostics aren't cached.
+
+    With coalesce=True, concurrent calls for the same citation (see
+    canonicalize_query) share a single API request.
+
+    Cached and shared data is returned as a shallow copy with the caller's
+    own rfr_id, sid and rfe_dat in echoedQuery.queryString, so referrer ids
+    carry over to Resolved.openurl.
+
+    Pass a Link360Client to reuse its pooled connections; its key and
+    timeout are then used in place of the key and timeout arguments.
+
+    observer, or the one installed with py360link.metrics.set_observer,
+    is sent a Trace of the call's stage timings; see py360link.metrics.
+
+    fallback, if given, is called as fallback(query, error) when the
+    request fails with CircuitOpen or a transient error (see
+    py360link.resilience.is_transient), and its return value is returned
+    instead of raising.  Pass fallback_on, a function of the error, to
+    choose which errors fall back instead.  Retries, hedging and circuit
+    breaking are configured on Link360Client; see py360link.resilience.
+
+    With lazy=True a LazySersolData view of the response is returned, and
+    only the parts that are read get converted.  Views are materialized
+    before being cached, so cache hits return plain dictionaries.
     
     """
     if query is None:
         raise Link360Exception('OpenURL query required.')
-    doc = get_sersol_response(query, key, timeout)
-    data = Link360JSON(doc).convert()
+    if client is not None:
+        key = client.key
+    if fallback is not None:
+        try:
+            return get_sersol_data(query, key, timeout, cache, coalesce,
+                                   client, observer, lazy=lazy)
+        except Exception, e:
+            if not (fallback_on or _falls_back)(e):
+                raise
+            return fallback(query, e)
+    observer = get_observer(observer)
+    if observer is None:
+        return _get_sersol_data(query, key, timeout, cache, coalesce, client,
+                                None, lazy)
+    trace = Trace('lookup', query, key)
+    try:
+        data = _get_sersol_data(query, key, timeout, cache, coalesce, client,
+                                trace, lazy)
+    except Exception, e:
+        trace.finish(e)
+        observer.on_trace(trace)
+        raise
+    trace.finish()
+    trace.count(data)
+    observer.on_trace(trace)
     return data
 
+def _falls_back(error):
+    #resilience imports this module.
+    from resilience import is_transient
+    return isinstance(error, CircuitOpen) or is_transient(error)
+
+def _echo_for(echo, query):
+    """
+    A stored echoedQuery.queryString with its caller parameters replaced by
+    those in query.  The rest, including the version parameters 360Link
+    echoes back, is kept as it was.
+    """
+    def split(s):
+        return [p for p in s.lstrip('?').split('&') if p]
+    def is_caller(p):
+        return p.split('=', 1)[0] in CALLER_PARAMS
+    own = [p for p in split(query) if is_caller(p)]
+    kept = []
+    theirs = []
+    for p in split(echo or ''):
+        if is_caller(p):
+            theirs.append(p)
+        else:
+            kept.append(p)
+    if theirs == own:
+        return echo
+    return '&'.join(kept + own)
+
+def _for_query(data, query):
+    """
+    data from a cache or another caller's request, as a shallow copy whose
+    echoedQuery has this caller's rfr_id, sid and rfe_dat.  The query key
+    leaves out rfr_id and sid, so the stored ones may be someone else's
+    and would otherwise leak into Resolved.openurl.
+    """
+    echoed = data.get('echoedQuery')
+    if echoed is None:
+        return data
+    query_string = _echo_for(echoed.get('queryString'), query)
+    if query_string == echoed.get('queryString'):
+        return data
+    echoed = dict(echoed)
+    echoed['queryString'] = query_string
+    if isinstance(data, LazySersolData):
+        #Share what the other view has converted already.
+        copy = LazySersolData(data.element)
+        copy._values.update(data._values)
+        copy._values['echoedQuery'] = echoed
+        return copy
+    copy = dict(data)
+    copy['echoedQuery'] = echoed
+    return copy
+
+def _get_sersol_data(query, key, timeout, cache, coalesce, client, trace,
+                     lazy):
+    ckey = None
+    if cache is not None or coalesce:
+        ckey = cache_key(query, key)
+    if cache is not None:
+        data = cache.get(ckey)
+        if trace is not None:
+            trace.cache = 'miss' if data is None else 'hit'
+        if data is not None:
+            return _for_query(data, query)
+    if coalesce:
+        led = []
+        def fetch():
+            led.append(True)
+            return _fetch_sersol_data(query, key, timeout, cache, ckey, client,
+                                      trace, lazy)
+        data = INFLIGHT.do(ckey, fetch)
+        if led:
+            return data
+        return _for_query(data, query)
+    return _fetch_sersol_data(query, key, timeout, cache, ckey, client, trace,
+                              lazy)
+
+def iter_sersol_data(query, key=None, timeout=5):
+    """
+    Generator version of get_sersol_data.  The response is parsed
+    incrementally and each result is yielded, as a dictionary in the
+    same form as the items of get_sersol_data(...)['results'], once it
+    has been read.  Memory use stays flat no matter how many results or
+    link groups the response holds.
+
+    Raises a Link360Exception if the API returns diagnostics.  Use
+    Link360Stream directly for the header data or link groups one at a time.
+    """
+    if query is None:
+        raise Link360Exception('OpenURL query required.')
+    f = open_sersol_response(query, key, timeout)
+    try:
+        stream = Link360Stream(f)
+        for result in stream.results():
+            yield result
+    finally:
+        f.close()
+
+#Namespaces used in the 360Link XML responses.
+NS = {
+    "ss" : "http://xml.serialssolutions.com/ns/openurl/v1.0",
+    "sd" : "http://xml.serialssolutions.com/ns/diagnostics/v1.0",
+    "dc" : "http://purl.org/dc/elements/1.1/"
+}
+
+def _tag(prefix, name):
+    """Clark notation tag, e.g. {http://purl.org/dc/elements/1.1/}title"""
+    return '{%s}%s' % (NS[prefix], name)
+
+def _xp(xpathexpr):
+    return etree.XPath(xpathexpr, namespaces=NS)
+
+#XPath expressions are compiled once at import time rather than on every
+#call to Link360JSON.convert.
+_VERSION = _xp("//ss:version/text()")
+_QUERY_STRING = _xp("//ss:echoedQuery/ss:queryString/text()")
+_TIMESTAMP = _xp("//ss:echoedQuery/@timeStamp")
+_LIBRARY_NAME = _xp("//ss:echoedQuery/ss:library/ss:name/text()")
+_LIBRARY_ID = _xp("//ss:echoedQuery/ss:library/@id")
+_DB_DATE = _xp("//ss:results/@dbDate")
+_RESULTS = _xp("//ss:result")
+_LINK_GROUPS = _xp("./ss:linkGroups/ss:linkGroup")
+_DIAGNOSTICS = _xp("//sd:diagnostic")
+_ECHOED_QUERY_STRING = _xp("./ss:queryString/text()")
+_ECHOED_LIBRARY_NAME = _xp("./ss:library/ss:name/text()")
+_ECHOED_LIBRARY_ID = _xp("./ss:library/@id")
+
+#Citation elements and the keys they are stored under.
+CITATION_MAP = {
+    _tag('dc', 'title'): 'title',
+    _tag('dc', 'creator'): 'creator',
+    _tag('dc', 'source'): 'source',
+    _tag('dc', 'date'): 'date',
+    _tag('dc', 'publisher'): 'publisher',
+    _tag('ss', 'creatorFirst'): 'creatorFirst',
+    _tag('ss', 'creatorMiddle'): 'creatorMiddle',
+    _tag('ss', 'creatorLast'): 'creatorLast',
+    _tag('ss', 'volume'): 'volume',
+    _tag('ss', 'issue'): 'issue',
+    _tag('ss', 'spage'): 'spage',
+    _tag('ss', 'doi'): 'doi',
+    _tag('ss', 'pmid'): 'pmid',
+    _tag('ss', 'publicationPlace'): 'publicationPlace',
+    _tag('ss', 'institution'): 'institution',
+    _tag('ss', 'advisor'): 'advisor',
+    _tag('ss', 'patentNumber'): 'patentNumber',
+    _tag('ss', 'eissn'): 'eissn',
+}
+_ISSN = _tag('ss', 'issn')
+_ISBN = _tag('ss', 'isbn')
+_CITATION_TAGS = tuple(CITATION_MAP.keys()) + (_ISSN, _ISBN)
+
+#Holding data elements and the keys they are stored under.
+HOLDING_MAP = {
+    _tag('ss', 'providerId'): 'providerId',
+    _tag('ss', 'providerName'): 'providerName',
+    _tag('ss', 'databaseId'): 'databaseId',
+    _tag('ss', 'databaseName'): 'databaseName',
+}
+_NORMALIZED = _tag('ss', 'normalizedData')
+_START_DATE = _tag('ss', 'startDate')
+_END_DATE = _tag('ss', 'endDate')
+_URL = _tag('ss', 'url')
+_HOLDING_TAGS = tuple(HOLDING_MAP.keys()) + (_START_DATE, _END_DATE)
+_VERSION_TAG = _tag('ss', 'version')
+_ECHOED_QUERY = _tag('ss', 'echoedQuery')
+_RESULTS_TAG = _tag('ss', 'results')
+_RESULT = _tag('ss', 'result')
+_CITATION = _tag('ss', 'citation')
+_LINK_GROUP = _tag('ss', 'linkGroup')
+_DIAGNOSTIC = _tag('sd', 'diagnostic')
+_DIAG_MAP = {
+    _tag('sd', 'uri'): 'uri',
+    _tag('sd', 'details'): 'details',
+    _tag('sd', 'message'): 'message',
+}
+
+def _first(r):
+    if len(r) > 0:
+        #Convert lxml "smart" strings to plain strings so the output doesn't
+        #hold a reference back to the parsed tree.
+        return r[0][:]
+    return None
+
+def _merge(dict, *kv):
+    """merge (k, v) pairs into dict if v is not None"""
+    for (k, v) in kv:
+        if v:
+            dict[k] = v
+    return dict
+
+def convert_citation(result):
+    """
+    Build the citation dict for a single ss:result (or ss:citation) element
+    in one pass over its descendants.
+    """
+    citation = {}
+    issn = {}
+    isbn = []
+    for el in result.iter(*_CITATION_TAGS):
+        tag = el.tag
+        if tag == _ISSN:
+            # assumes at most one ISSN per type
+            issn[el.get('type')] = el.text
+        elif tag == _ISBN:
+            isbn.append(el.text)
+        else:
+            k = CITATION_MAP[tag]
+            if el.text and k not in citation:
+                citation[k] = el.text
+    return _merge(citation,
+                  ('issn', issn),
+                  ('isbn', isbn))
+
+def _holding_data(group):
+    """
+    Build the holdingData dict for a single ss:linkGroup element.
+    """
+    holding = dict.fromkeys(HOLDING_MAP.values())
+    dates = {}
+    for el in group.iter(*_HOLDING_TAGS):
+        tag = el.tag
+        if tag in HOLDING_MAP:
+            k = HOLDING_MAP[tag]
+            if holding[k] is None:
+                holding[k] = el.text or None
+        # output normalizedData/startDate instead of startDate,
+        # assuming that 'startDate' is redundant
+        elif el.getparent().tag == _NORMALIZED:
+            k = 'startDate' if tag == _START_DATE else 'endDate'
+            if el.text and k not in dates:
+                dates[k] = el.text
+    return _merge(holding,
+                  ('startDate', dates.get('startDate')),
+                  ('endDate', dates.get('endDate')))
+
+def _link_urls(group):
+    # assumes at most one URL per type
+    return dict([ (url.get('type'), url.text)
+                  for url in group.iterchildren(_URL) ])
+
+def convert_link_group(group):
+    """
+    Build the dict for a single ss:linkGroup element.
+    """
+    return {
+        'type' : group.get('type'),
+        'holdingData' : _holding_data(group),
+        'url' : _link_urls(group)
+    }
+
+def convert_result(result):
+    """
+    Build the dict for a single ss:result element.
+    """
+    return {
+        'format' : result.get('format'),
+        'citation' : convert_citation(result),
+        'linkGroups' : [ convert_link_group(group)
+                         for group in _LINK_GROUPS(result) ]
+    }
+
+def convert_diagnostic(diag):
+    """
+    Build the dict for a single sd:diagnostic element.
+    """
+    out = {}
+    for el in diag.iterchildren(*_DIAG_MAP.keys()):
+        k = _DIAG_MAP[el.tag]
+        if el.text and k not in out:
+            out[k] = el.text
+    return _merge({ 'uri' : out.get('uri') },
+                  ('details', out.get('details')),
+                  ('message', out.get('message')))
+
 class Link360JSON(object):
     """
     Convert Link360 XML To JSON
@@ -105,103 +626,627 @@ class Link360JSON(object):
         self.doc = doc
 
     def convert(self):
-
-        ns = {
-            "ss" : "http://xml.serialssolutions.com/ns/openurl/v1.0",
-            "sd" : "http://xml.serialssolutions.com/ns/diagnostics/v1.0",
-            "dc" : "http://purl.org/dc/elements/1.1/"
-        }
-
-        def x(xpathexpr, root = self.doc):
-            return root.xpath(xpathexpr, namespaces=ns)
-
-        def t(xpathexpr, root = self.doc):
-            r = x(xpathexpr, root)
-            if len(r) > 0:
-                return r[0]
-            return None
-
-        def m(dict, *kv):
-            """merge (k, v) pairs into dict if v is not None"""
-            for (k, v) in kv:
-                if v:
-                    dict[k] = v
-            return dict
-
-        return m({ 
-            'version' : t("//ss:version/text()"),
+        doc = self.doc
+        return _merge({
+            'version' : _first(_VERSION(doc)),
             'echoedQuery' : {
-                'queryString' : t("//ss:echoedQuery/ss:queryString/text()"),
-                'timeStamp' : t("//ss:echoedQuery/@timeStamp"),
+                'queryString' : _first(_QUERY_STRING(doc)),
+                'timeStamp' : _first(_TIMESTAMP(doc)),
                 'library' : {
-                    'name' : t("//ss:echoedQuery/ss:library/ss:name/text()"),
-                    'id' : t("//ss:echoedQuery/ss:library/@id")
+                    'name' : _first(_LIBRARY_NAME(doc)),
+                    'id' : _first(_LIBRARY_ID(doc))
                 }
             },
-            'dbDate' : t("//ss:results/@dbDate"),
-            'results' : [ {
-                'format' : t("./@format", result),
-                'citation' : m({ },
-                    ('title', t(".//dc:title/text()")),
-                    ('creator', t(".//dc:creator/text()")),
-                    ('source', t(".//dc:source/text()")),
-                    ('date', t(".//dc:date/text()")),
-                    ('publisher', t(".//dc:publisher/text()")),
-                    ('creatorFirst', t(".//ss:creatorFirst/text()")),
-                    ('creatorMiddle', t(".//ss:creatorMiddle/text()")),
-                    ('creatorLast', t(".//ss:creatorLast/text()")),
-                    ('volume', t(".//ss:volume/text()")),
-                    ('issue', t(".//ss:issue/text()")),
-                    ('spage', t(".//ss:spage/text()")),
-                    ('doi', t(".//ss:doi/text()")),
-                    ('pmid', t(".//ss:pmid/text()")),
-                    ('publicationPlace', t(".//ss:publicationPlace/text()")),
-                    ('institution', t(".//ss:institution/text()")),
-                    ('advisor', t(".//ss:advisor/text()")),
-                    ('patentNumber', t(".//ss:patentNumber/text()")),
-                    # assumes at most one ISSN per type
-                    ('issn', dict([ (t("./@type", issn), t("./text()", issn))
-                                   for issn in x("//ss:issn") ])),
-                    ('eissn', t(".//ss:eissn/text()")),
-                    ('isbn', [ t("./text()", isbn) for isbn in x("//ss:isbn") ])
-                ),
-                'linkGroups' : [ {
-                    'type' : t("./@type", group),
-                    'holdingData' : m({ 
-                            'providerId' : t(".//ss:providerId/text()", group),
-                            'providerName' : t(".//ss:providerName/text()", group),
-                            'databaseId' : t(".//ss:databaseId/text()", group),
-                            'databaseName' : t(".//ss:databaseName/text()", group),
-                        },
-                        # output normalizedData/startDate instead of startDate, 
-                        # assuming that 'startDate' is redundant
-                        ('startDate' , t(".//ss:normalizedData/ss:startDate/text()", group)),
-                        ('endDate' , t(".//ss:normalizedData/ss:endDate/text()", group))),
-                    # assumes at most one URL per type
-                    'url' : dict([ (t("./@type", url), t("./text()", url)) 
-                                   for url in x("./ss:url", group) ])
-                } for group in x("//ss:linkGroups/ss:linkGroup")]
-            } for result in x("//ss:result") ] }, 
+            'dbDate' : _first(_DB_DATE(doc)),
+            'results' : [ convert_result(result) for result in _RESULTS(doc) ] },
             # optional
-            ('diagnostics', 
-                [ m({ 'uri' : t("./sd:uri/text()", diag) },
-                    ('details', t("./sd:details/text()", diag)), 
-                    ('message', t("./sd:message/text()", diag))
-                ) for diag in x("//sd:diagnostic")]
+            ('diagnostics',
+                [ convert_diagnostic(diag) for diag in _DIAGNOSTICS(doc) ]
             )
             # TBD derivedQueryData
         )
-        
+
+#Marks a key that isn't in a lazy mapping.
+_MISSING = object()
+
+def _materialize(value):
+    """
+    Plain dict and list copy of a value from a lazy mapping.
+    """
+    if isinstance(value, (LazyMapping, LazyList)):
+        return value.materialize()
+    if isinstance(value, dict):
+        return dict((k, _materialize(v)) for k, v in value.iteritems())
+    if isinstance(value, list):
+        return [_materialize(v) for v in value]
+    return value
+
+class LazyMapping(object):
+    """
+    Read only dictionary over part of a parsed response.  Each value is
+    converted from the XML the first time it is asked for and then kept.
+    Subclasses list their possible keys in _fields and convert one with
+    _value, which returns _MISSING for keys Link360JSON would leave out.
+    """
+    _fields = ()
+
+    def __init__(self, element):
+        self.element = element
+        self._values = {}
+        self._loaded = None
+
+    def _value(self, key):
+        raise NotImplementedError
+
+    def _load(self):
+        """
+        Convert every key, for when all of them are needed, and return a
+        dict of those present.  The keys are added in the same order as
+        Link360JSON adds them so they iterate in the same order.
+        """
+        present = {}
+        for key in self._fields:
+            value = self._get(key)
+            if value is not _MISSING:
+                present[key] = value
+        return present
+
+    def _get(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            value = self._values[key] = self._value(key)
+            return value
+
+    def __getitem__(self, key):
+        if key in self._fields:
+            value = self._get(key)
+            if value is not _MISSING:
+                return value
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    has_key = __contains__
+
+    def iteritems(self):
+        if self._loaded is None:
+            self._loaded = self._load()
+        return self._loaded.iteritems()
+
+    def items(self):
+        return list(self.iteritems())
+
+    def keys(self):
+        return [k for k, v in self.iteritems()]
+
+    def values(self):
+        return [v for k, v in self.iteritems()]
+
+    def __iter__(self):
+        for k, v in self.iteritems():
+            yield k
+
+    def __len__(self):
+        return len(self.keys())
+
+    def materialize(self):
+        """
+        The dictionary Link360JSON.convert makes for this part.
+        """
+        return dict((k, _materialize(v)) for k, v in self.iteritems())
+
+    def __eq__(self, other):
+        if isinstance(other, LazyMapping):
+            other = other.materialize()
+        elif not isinstance(other, dict):
+            return NotImplemented
+        return self.materialize() == other
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, self.materialize())
+
+class LazyList(object):
+    """
+    Read only list of elements, each wrapped in cls on first access.
+    """
+    def __init__(self, elements, cls):
+        self._elements = elements
+        self._items = [None] * len(elements)
+        self._cls = cls
+
+    def __len__(self):
+        return len(self._elements)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self)))]
+        item = self._items[index]
+        if item is None:
+            item = self._items[index] = self._cls(self._elements[index])
+        return item
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def materialize(self):
+        return [item.materialize() for item in self]
+
+    def __eq__(self, other):
+        if isinstance(other, LazyList):
+            other = other.materialize()
+        elif not isinstance(other, list):
+            return NotImplemented
+        return self.materialize() == other
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '<LazyList of %d %s>' % (len(self), self._cls.__name__)
+
+#Citation keys and the elements they are read from.
+_CITATION_TAG = dict((v, k) for k, v in CITATION_MAP.items())
+
+class LazyCitation(LazyMapping):
+    """
+    Citation of an ss:result element.  A single field is found with one
+    scan for its element; listing the keys converts them all in one pass.
+    """
+    _fields = tuple(sorted(CITATION_MAP.values())) + ('issn', 'isbn')
+
+    def _value(self, key):
+        if key == 'issn':
+            value = dict((el.get('type'), el.text)
+                         for el in self.element.iter(_ISSN))
+        elif key == 'isbn':
+            value = [el.text for el in self.element.iter(_ISBN)]
+        else:
+            value = None
+            for el in self.element.iter(_CITATION_TAG[key]):
+                if el.text:
+                    value = el.text
+                    break
+        return value or _MISSING
+
+    def _load(self):
+        citation = convert_citation(self.element)
+        for key in self._fields:
+            value = self._values.get(key)
+            if value is None:
+                self._values[key] = citation.get(key, _MISSING)
+            elif value is not _MISSING:
+                #Keep the values already handed out.
+                citation[key] = value
+        return citation
+
+class LazyLinkGroup(LazyMapping):
+    """
+    An ss:linkGroup element.  The urls can be read without converting the
+    holding data.
+    """
+    _fields = ('type', 'holdingData', 'url')
+
+    def _value(self, key):
+        if key == 'type':
+            return self.element.get('type')
+        if key == 'url':
+            return _link_urls(self.element)
+        return _holding_data(self.element)
+
+class LazyResult(LazyMapping):
+    """
+    An ss:result element.
+    """
+    _fields = ('format', 'citation', 'linkGroups')
+
+    def _value(self, key):
+        if key == 'format':
+            return self.element.get('format')
+        if key == 'citation':
+            return LazyCitation(self.element)
+        return LazyList(_LINK_GROUPS(self.element), LazyLinkGroup)
+
+class LazySersolData(LazyMapping):
+    """
+    Lazy view of a whole parsed response, usable wherever the dictionary
+    from Link360JSON.convert is.  Only the parts that are read get
+    converted:
+
+        data = LazySersolData(doc)
+        data['results'][0]['linkGroups'][0]['url']
+
+    materialize() returns the same dictionary Link360JSON(doc).convert()
+    does.  The view keeps the parsed tree alive, so materialize it before
+    storing it for long.
+    """
+    _fields = ('version', 'echoedQuery', 'dbDate', 'results', 'diagnostics')
+
+    def _value(self, key):
+        doc = self.element
+        if key == 'version':
+            return _first(_VERSION(doc))
+        if key == 'echoedQuery':
+            return {
+                'queryString' : _first(_QUERY_STRING(doc)),
+                'timeStamp' : _first(_TIMESTAMP(doc)),
+                'library' : {
+                    'name' : _first(_LIBRARY_NAME(doc)),
+                    'id' : _first(_LIBRARY_ID(doc))
+                }
+            }
+        if key == 'dbDate':
+            return _first(_DB_DATE(doc))
+        if key == 'results':
+            return LazyList(_RESULTS(doc), LazyResult)
+        return [ convert_diagnostic(diag)
+                 for diag in _DIAGNOSTICS(doc) ] or _MISSING
+
+def _release(elem):
+    """
+    Free an element that has been converted, along with any siblings
+    already processed, so the partial tree built by iterparse stays small.
+    """
+    elem.clear()
+    parent = elem.getparent()
+    if parent is not None:
+        while elem.getprevious() is not None:
+            del parent[0]
+
+class Link360Stream(object):
+    """
+    Incrementally convert a Link360 XML response using etree.iterparse.
+
+    Iterating over the stream yields (kind, value) pairs as elements are
+    completed:
+        ('result', {'format': ..., 'citation': {...}})
+        ('linkGroup', {...})  - belongs to the last 'result'
+        ('diagnostic', {...})
+
+    The version, echoedQuery and dbDate values are collected in self.info
+    as they are read.  Elements are cleared once converted.
+    """
+    def __init__(self, source):
+        self.source = source
+        self.info = {}
+
+    def __iter__(self):
+        tags = (_VERSION_TAG, _ECHOED_QUERY, _RESULTS_TAG, _RESULT,
+                _CITATION, _LINK_GROUP, _DIAGNOSTIC)
+        result_format = None
+        pending = False
+        for event, elem in etree.iterparse(self.source, events=('start', 'end'),
+                                           tag=tags):
+            tag = elem.tag
+            if event == 'start':
+                if tag == _RESULTS_TAG:
+                    _merge(self.info, ('dbDate', elem.get('dbDate')))
+                elif tag == _RESULT:
+                    result_format = elem.get('format')
+                    pending = True
+                continue
+            if tag == _LINK_GROUP:
+                if pending:
+                    #No citation element before the link groups.
+                    pending = False
+                    yield 'result', {'format': result_format, 'citation': {}}
+                yield 'linkGroup', convert_link_group(elem)
+                _release(elem)
+            elif tag == _CITATION:
+                if pending:
+                    pending = False
+                    yield 'result', {'format': result_format,
+                                     'citation': convert_citation(elem)}
+            elif tag == _RESULT:
+                if pending:
+                    pending = False
+                    yield 'result', {'format': result_format,
+                                     'citation': convert_citation(elem)}
+                _release(elem)
+            elif tag == _DIAGNOSTIC:
+                yield 'diagnostic', convert_diagnostic(elem)
+                _release(elem)
+            elif tag == _VERSION_TAG:
+                _merge(self.info, ('version', elem.text))
+            elif tag == _ECHOED_QUERY:
+                self.info['echoedQuery'] = {
+                    'queryString' : _first(_ECHOED_QUERY_STRING(elem)),
+                    'timeStamp' : elem.get('timeStamp'),
+                    'library' : {
+                        'name' : _first(_ECHOED_LIBRARY_NAME(elem)),
+                        'id' : _first(_ECHOED_LIBRARY_ID(elem))
+                    }
+                }
+
+    def results(self):
+        """
+        Yield each result with its linkGroups, one result at a time.
+        Raises a Link360Exception if the response carries diagnostics.
+        """
+        current = None
+        for kind, value in self:
+            if kind == 'linkGroup':
+                current['linkGroups'].append(value)
+            elif kind == 'result':
+                if current is not None:
+                    yield current
+                current = value
+                current['linkGroups'] = []
+            elif kind == 'diagnostic':
+                raise Link360Exception(value.get('message') or value.get('uri'))
+        if current is not None:
+            yield current
+
+#Query parameters carried over from the original query to the OpenURL.
+RETAINED_PARAMS = ('rfe_dat', 'rfr_id', 'sid')
+
+_OPENURL_TRAILERS = {
+    'book': [('url_ver', 'Z39.88-2004'), ('version', '1.0'),
+             ('rft_val_fmt', 'info:ofi/fmt:kev:mtx:book'),
+             ('rft.genre', 'book')],
+    #for now will treat all non-books as journals
+    'journal': [('url_ver', 'Z39.88-2004'), ('version', '1.0'),
+                ('rft_val_fmt', 'info:ofi/fmt:kev:mtx:journal'),
+                ('rft.genre', 'article')],
+}
+
+def _encode_pair(k, v, out):
+    """
+    Append k=v to out the way urllib.urlencode(..., doseq=True) encodes it.
+    k is already quoted.
+    """
+    if isinstance(v, str):
+        out.append(k + '=' + urllib.quote_plus(v))
+    elif isinstance(v, unicode):
+        out.append(k + '=' + urllib.quote_plus(v.encode('ASCII', 'replace')))
+    else:
+        try:
+            len(v)
+        except TypeError:
+            out.append(k + '=' + urllib.quote_plus(str(v)))
+        else:
+            for elt in v:
+                out.append(k + '=' + urllib.quote_plus(str(elt)))
+
+class OpenURLBuilder(object):
+    """
+    Builds the OpenURL for a citation, as Resolved.openurl_pairs and
+    Resolved.openurl do, from tables worked out once per format: the
+    OpenURL key and how to add each citation key, and the quoted form of
+    every key.  The encoded form of up to memo_size recent key, value
+    pairs is kept too, since genres, dates, journal titles and the like
+    repeat across records.  One builder can be shared by any number of
+    threads.
+    """
+    def __init__(self, sersol_map=SERSOL_MAP, retain=RETAINED_PARAMS,
+                 memo_size=10000):
+        self.sersol_map = sersol_map
+        self.retain = retain
+        self.memo_size = memo_size
+        self._tables = {}
+        self._quoted = {}
+        self._encoded = {}
+        self._trailers = {}
+        for format, pairs in _OPENURL_TRAILERS.items():
+            out = []
+            for k, v in pairs:
+                _encode_pair(k, v, out)
+            self._trailers[format] = (pairs, '&'.join(out))
+
+    def _table(self, format):
+        table = self._tables.get(format)
+        if table is None:
+            table = self._tables[format] = {}
+        return table
+
+    def _entry(self, table, format, key):
+        """
+        How to add citation key: ('issn', None), ('doi', None),
+        ('pmid', None) or ('rft.<openurl key>', quoted).
+        """
+        entry = table.get(key)
+        if entry is None:
+            if key == 'issn':
+                entry = ('issn', None)
+            else:
+                k = self.sersol_map.get(format, {}).get(key, key)
+                if k in ('doi', 'pmid'):
+                    entry = (k, None)
+                else:
+                    k = 'rft.%s' % k
+                    entry = (k, self.quote(k))
+            table[key] = entry
+        return entry
+
+    def _encode(self, k, v, out):
+        """
+        _encode_pair, remembering the result for string values.
+        """
+        if type(v) is not str:
+            _encode_pair(k, v, out)
+            return
+        pair = self._encoded.get((k, v))
+        if pair is None:
+            pair = k + '=' + urllib.quote_plus(v)
+            if len(self._encoded) >= self.memo_size:
+                self._encoded.clear()
+            self._encoded[(k, v)] = pair
+        out.append(pair)
+
+    def quote(self, key):
+        quoted = self._quoted.get(key)
+        if quoted is None:
+            quoted = self._quoted[key] = urllib.quote_plus(str(key))
+        return quoted
+
+    def retained(self, query_dict):
+        """
+        The pairs carried over from a parsed query (see RETAINED_PARAMS).
+        """
+        out = []
+        for key in self.retain:
+            val = query_dict.get(key, None)
+            if val:
+                out.append((key, val))
+        return out
+
+    def retained_from_query(self, query):
+        """
+        retained(urlparse.parse_qs(query)), unquoting only the retained
+        parameters.
+        """
+        found = {}
+        for part in query.split('&'):
+            for name_value in part.split(';'):
+                name, sep, value = name_value.partition('=')
+                if not value:
+                    continue
+                if '%' in name or '+' in name:
+                    name = urllib.unquote(name.replace('+', ' '))
+                if name in self.retain:
+                    value = urllib.unquote(value.replace('+', ' '))
+                    found.setdefault(name, []).append(value)
+        return [(key, found[key]) for key in self.retain if key in found]
+
+    def pairs(self, format, citation, retained=()):
+        """
+        OpenURL (key, value) pairs for a citation of the given format,
+        followed by the retained pairs.
+        """
+        table = self._table(format)
+        out = []
+        for k, v in citation.items():
+            kind = self._entry(table, format, k)[0]
+            #Handle issns differently.  They are a dict in the 360LinkJSON response.
+            if kind == 'issn':
+                issn = v.get('print', None) if isinstance(v, dict) else v
+                if issn:
+                    out.append(('rft.issn', issn))
+            elif kind == 'doi':
+                out.append(('rft_id', 'info:doi/%s' % v))
+            elif kind == 'pmid':
+                #We will append a plain pmid for systems that will resolve that.
+                out.append(('pmid', v))
+                out.append(('rft_id', 'info:pmid/%s' % v))
+            else:
+                out.append((kind, v))
+        out.extend(self._trailers['book' if format == 'book' else 'journal'][0])
+        out.extend(retained)
+        return out
+
+    def kev(self, format, citation, retained=()):
+        """
+        The OpenURL query string, equal to urllib.urlencode(self.pairs(...),
+        doseq=True) but built without the intermediate pairs.
+        """
+        table = self._table(format)
+        encode = self._encode
+        out = []
+        for k, v in citation.items():
+            kind, quoted = self._entry(table, format, k)
+            if kind == 'issn':
+                issn = v.get('print', None) if isinstance(v, dict) else v
+                if issn:
+                    encode('rft.issn', issn, out)
+            elif kind == 'doi':
+                encode('rft_id', 'info:doi/%s' % v, out)
+            elif kind == 'pmid':
+                encode('pmid', v, out)
+                encode('rft_id', 'info:pmid/%s' % v, out)
+            else:
+                encode(quoted, v, out)
+        out.append(self._trailers['book' if format == 'book' else 'journal'][1])
+        for k, v in retained:
+            encode(self.quote(k), v, out)
+        return '&'.join(out)
+
+    def encode(self, pairs):
+        """
+        urllib.urlencode(pairs, doseq=True), reusing the quoted keys.
+        """
+        encode = self._encode
+        quote = self.quote
+        out = []
+        for k, v in pairs:
+            encode(quote(k), v, out)
+        return '&'.join(out)
+
+    def coins(self, format, citation, retained=()):
+        """
+        COinS span for a citation, see http://ocoins.info.
+        """
+        return coins_span(self.kev(format, citation, retained))
+
+def coins_span(kev):
+    """
+    Wrap an OpenURL query string in a COinS span.
+    """
+    return '<span class="Z3988" title="%s"></span>' % cgi.escape(
+        'ctx_ver=Z39.88-2004&' + kev, True)
+
+#Used by Resolved and the export functions.
+OPENURL_BUILDER = OpenURLBuilder()
+
+class memoized_property(object):
+    """
+    Property computed on first access and then stored on the instance.
+    """
+    def __init__(self, fget):
+        self.fget = fget
+        self.__name__ = fget.__name__
+        self.__doc__ = fget.__doc__
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        value = obj.__dict__[self.__name__] = self.fget(obj)
+        return value
+
+_OCLC_NUMBER = re.compile('\d+')
 
 class Resolved(object):
     """
     Object for handling resolved Sersol queries.
+
+    The parsed query, OpenURL and OCLC number are computed on first use and
+    then kept, so treat the data as read only once they have been accessed.
+
+    data can also be a LazySersolData view, from get_sersol_data(...,
+    lazy=True), in which case only the fields used are converted.
+
+    observer, or the installed default, is sent a Trace timing the
+    building of openurl_pairs.
     """
-    def __init__(self, data):
+    def __init__(self, data, observer=None):
         self.data = data
+        self.observer = get_observer(observer)
         self.query = data['echoedQuery']['queryString']
         self.library = data['echoedQuery']['library']['name']
-        self.query_dict = urlparse.parse_qs(self.query)
         error = self.data.get('diagnostics', None)
         if error:
             msg = ' '.join([e.get('message') for e in error if e])
@@ -211,25 +1256,48 @@ class Resolved(object):
         self.citation = data['results'][0]['citation']
         self.link_groups = data['results'][0]['linkGroups']
         self.format = data['results'][0]['format']
-    
-        
+
+    @memoized_property
+    def query_dict(self):
+        return urlparse.parse_qs(self.query)
+
     @property
+    def results(self):
+        """
+        All results returned, not just the first.
+        """
+        return self.data['results']
+
+    def iter_results(self):
+        """
+        Yield (format, citation, link_groups) for each result.
+        """
+        for result in self.data['results']:
+            yield result['format'], result['citation'], result['linkGroups']
+
+    def iter_link_groups(self):
+        """
+        Yield the link groups of every result in turn.
+        """
+        for result in self.data['results']:
+            for group in result['linkGroups']:
+                yield group
+        
+    @memoized_property
     def openurl(self):
-        return urllib.urlencode(self.openurl_pairs(), doseq=True)
+        return OPENURL_BUILDER.encode(self.openurl_pairs())
     
-    @property
+    @memoized_property
     def oclc_number(self):
         """
         Parse the original query string and retain certain key, values.
         Primarily meant for storing the worldcat accession number passed on
         by Worldcat.org/FirstSearch
         """
-        import re
-        reg = re.compile('\d+')
         dat = self.query_dict.get('rfe_dat', None)
         if dat:
             #get the first one because dat is a list
-            match = reg.search(dat[0])
+            match = _OCLC_NUMBER.search(dat[0])
             if match:
                 return match.group()
         return
@@ -243,14 +1311,10 @@ class Resolved(object):
         This could be also helpful for retaining any other metadata that won't
         be returned from the 360Link API.
         """
-        retain = ['rfe_dat', 'rfr_id', 'sid']
-        parsed = urlparse.parse_qs(self.query)
-        out = []
-        for key in retain:
-            val = parsed.get(key, None)
-            if val:
-                out.append((key, val))
-        return out
+        if 'query_dict' in self.__dict__:
+            return OPENURL_BUILDER.retained(self.query_dict)
+        #Only the retained parameters are needed, not the whole parsed query.
+        return OPENURL_BUILDER.retained_from_query(self.query)
     
     def openurl_pairs(self):
         """
@@ -260,56 +1324,55 @@ class Resolved(object):
         Subclass this to handle needs for specific system.
         
         See http://ocoins.info/cobg.html for implementation guidelines.
+
+        The pairs are built once; a new list is returned on each call.
         """
-        query = urlparse.parse_qs(self.query)
-        format = self.format
-        #Pop invalid rft_id from OCLC
-        try:
-            
-            if query['rft_id'][0].startswith('info:oclcnum'):
-                del query['rft_id']
-        except KeyError:
-            pass
-        #Massage the citation into an OpenURL
-        #Using a list of tuples here to account for the possiblity of repeating values.
-        out = []
-        for k, v in self.citation.items():
-            #Handle issns differently.  They are a dict in the 360LinkJSON response.
-            if k == 'issn':
-                issn_dict = self.citation[k]
-                if isinstance(issn_dict, dict):
-                    issn = issn_dict.get('print', None)
-                else:
-                    issn = issn_dict
-                if issn:
-                    out.append(('rft.issn', issn))
-                continue
-            #Handle remaining keys. 
-            try:
-                k = SERSOL_MAP[format][k]
-            except KeyError:
-                pass
-            #handle ids separately 
-            if (k == 'doi'):
-                out.append(('rft_id', 'info:doi/%s' % v))
-            elif (k == 'pmid'):
-                #We will append a plain pmid for systems that will resolve that.
-                out.append(('pmid', v))
-                out.append(('rft_id', 'info:pmid/%s' % v))
+        pairs = self.__dict__.get('_openurl_pairs')
+        if pairs is None:
+            if self.observer is None:
+                pairs = self._build_openurl_pairs()
             else:
-                out.append(('rft.%s' % k, v))
-        #versioning
-        out.append(('url_ver', 'Z39.88-2004'))
-        out.append(('version', '1.0'))
-        #handle formats
-        if format == 'book':
-            out.append(('rft_val_fmt', 'info:ofi/fmt:kev:mtx:book'))  
-            out.append(('rft.genre', 'book'))
-        #for now will treat all non-books as journals
-        else:
-            out.append(('rft_val_fmt', 'info:ofi/fmt:kev:mtx:journal')) 
-            out.append(('rft.genre', 'article'))
-        #Get the special keys.   
-        retained_values = self._retain_ourl_params()
-        out += retained_values
-        return out
+                trace = Trace('resolve', self.query)
+                with trace.time('openurl_pairs'):
+                    pairs = self._build_openurl_pairs()
+                trace.finish()
+                self.observer.on_trace(trace)
+            self._openurl_pairs = pairs
+        return list(pairs)
+
+    def _build_openurl_pairs(self):
+        #The original query's rft_id, including the invalid info:oclcnum
+        #one OCLC sends, isn't carried over; ids come from the citation.
+        return OPENURL_BUILDER.pairs(self.format, self.citation,
+                                     self._retain_ourl_params())
+
+def _resolved(record):
+    if isinstance(record, Resolved):
+        return record
+    return Resolved(record)
+
+def export_kev(records):
+    """
+    OpenURL query strings for records, Resolved objects or get_sersol_data
+    dictionaries, in one pass.  Resolved subclasses that change
+    openurl_pairs get their own OpenURLs.
+    """
+    out = []
+    kev = OPENURL_BUILDER.kev
+    for record in records:
+        record = _resolved(record)
+        if type(record) is not Resolved:
+            out.append(record.openurl)
+            continue
+        openurl = record.__dict__.get('openurl')
+        if openurl is None:
+            openurl = kev(record.format, record.citation,
+                          record._retain_ourl_params())
+        out.append(openurl)
+    return out
+
+def export_coins(records):
+    """
+    COinS spans, see http://ocoins.info, for records as in export_kev.
+    """
+    return [coins_span(kev) for kev in export_kev(records)]
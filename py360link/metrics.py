@@ -0,0 +1,189 @@
+"""
+Timing and metrics hooks for lookups.
+
+An observer is any object with an on_trace(trace) method.  Pass one to
+get_sersol_data or Resolved, or install one for the whole process with
+set_observer.  With no observer nothing is timed.
+
+Lookup traces (kind 'lookup') can have these stages, in seconds:
+
+    throttle  waiting for a RateLimiter slot (Link360Client only)
+    connect   opening a new connection (Link360Client only)
+    request   sending the request until response headers arrive
+    read      reading the response body
+    parse     etree.parse
+    convert   Link360JSON.convert
+
+Without a Link360Client each lookup opens a new connection through
+urllib2, and the DNS lookup and connect time is counted in request.  Pass
+a Link360Client to see it separately as connect.
+
+Resolved traces (kind 'resolve') time building openurl_pairs.
+"""
+import threading
+from collections import deque
+from timeit import default_timer as timer
+
+class Trace(object):
+    """
+    What happened during one call: stage durations, response size, result
+    and link group counts, cache outcome and the error class if it failed.
+    """
+    def __init__(self, kind, query=None, key=None):
+        self.kind = kind
+        self.query = query
+        self.key = key
+        self.stages = []
+        self.bytes = None
+        self.results = None
+        self.link_groups = None
+        self.cache = None
+        self.error = None
+        self.total = None
+        self._start = timer()
+
+    def time(self, name):
+        """
+        Context manager recording the time spent in a stage.
+        """
+        return _Stage(self, name)
+
+    def add(self, name, seconds):
+        self.stages.append((name, seconds))
+
+    def count(self, data):
+        """
+        Record the result and link group counts of converted data.
+        """
+        results = data.get('results') or []
+        self.results = len(results)
+        self.link_groups = sum(len(r['linkGroups']) for r in results)
+
+    def finish(self, error=None):
+        self.total = timer() - self._start
+        if error is not None:
+            self.error = error.__class__.__name__
+
+    def as_dict(self):
+        return {
+            'kind': self.kind,
+            'query': self.query,
+            'key': self.key,
+            'stages': dict(self.stages),
+            'bytes': self.bytes,
+            'results': self.results,
+            'link_groups': self.link_groups,
+            'cache': self.cache,
+            'error': self.error,
+            'total': self.total,
+        }
+
+    def __repr__(self):
+        stages = ' '.join('%s=%.1fms' % (n, s * 1000) for n, s in self.stages)
+        return '<Trace %s %s>' % (self.kind, stages)
+
+class _Stage(object):
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.start = timer()
+        return self
+
+    def __exit__(self, *exc):
+        self.trace.add(self.name, timer() - self.start)
+        return False
+
+class Observer(object):
+    """
+    Base class for observers.  on_trace is called once per finished call,
+    from the thread that made it, so implementations should be quick and
+    thread safe.
+    """
+    def on_trace(self, trace):
+        pass
+
+class MetricsCollector(Observer):
+    """
+    Aggregate traces in memory: per stage counts and percentiles over the
+    last sample_size timings, bytes received, results and errors by class.
+    """
+    def __init__(self, sample_size=10000):
+        self.sample_size = sample_size
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.calls = 0
+            self.bytes = 0
+            self.results = 0
+            self.link_groups = 0
+            self.errors = {}
+            self.cache = {}
+            self._samples = {}
+
+    def _sample(self, name, seconds):
+        samples = self._samples.get(name)
+        if samples is None:
+            samples = self._samples[name] = deque(maxlen=self.sample_size)
+        samples.append(seconds)
+
+    def on_trace(self, trace):
+        with self._lock:
+            self.calls += 1
+            for name, seconds in trace.stages:
+                self._sample(name, seconds)
+            if trace.total is not None:
+                self._sample('%s_total' % trace.kind, trace.total)
+            self.bytes += trace.bytes or 0
+            self.results += trace.results or 0
+            self.link_groups += trace.link_groups or 0
+            if trace.error:
+                self.errors[trace.error] = self.errors.get(trace.error, 0) + 1
+            if trace.cache:
+                self.cache[trace.cache] = self.cache.get(trace.cache, 0) + 1
+
+    def summary(self):
+        """
+        Dictionary of the totals and, for each stage, count, mean and
+        p50/p90/p99 in seconds.
+        """
+        with self._lock:
+            stages = {}
+            for name, samples in self._samples.items():
+                times = sorted(samples)
+                n = len(times)
+                stages[name] = {
+                    'count': n,
+                    'mean': sum(times) / n,
+                    'p50': times[int((n - 1) * 0.50)],
+                    'p90': times[int((n - 1) * 0.90)],
+                    'p99': times[int((n - 1) * 0.99)],
+                    'max': times[-1],
+                }
+            return {
+                'calls': self.calls,
+                'bytes': self.bytes,
+                'results': self.results,
+                'link_groups': self.link_groups,
+                'errors': dict(self.errors),
+                'cache': dict(self.cache),
+                'stages': stages,
+            }
+
+#Process wide observer used when none is passed in.
+OBSERVER = None
+
+def set_observer(observer):
+    """
+    Install an observer for all lookups, or None to turn metrics off.
+    """
+    global OBSERVER
+    OBSERVER = observer
+
+def get_observer(observer=None):
+    if observer is not None:
+        return observer
+    return OBSERVER
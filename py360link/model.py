@@ -0,0 +1,206 @@
+"""
+Compact representation of the dictionaries made by Link360JSON.convert.
+
+Each level of the response is a class with __slots__ instead of a dict, and
+repeated strings such as provider and database names are interned so
+records share them.  The records support read only dictionary access, so
+Resolved and other code written for the dictionaries can use them
+unchanged:
+
+    data = SersolData.from_dict(get_sersol_data(query, key=key))
+    resolved = Resolved(data)
+    data.to_dict() == get_sersol_data(query, key=key)
+"""
+
+#Values repeated across many records, e.g. provider names, share one copy.
+#Unlike a table of our own, interned strings are freed once no record uses
+#them.
+def _share(value):
+    if type(value) is str:
+        return intern(value)
+    return value
+
+class Record(object):
+    """
+    Base class.  Subclasses list their keys in _fields.  Keys in _required
+    are always present in the dictionary form, even when None; the others
+    are left out when empty, as Link360JSON does.  Keys not in _fields are
+    kept in extra so the conversion is lossless.
+    """
+    __slots__ = ('extra',)
+    _fields = ()
+    _required = ()
+
+    def __init__(self, **kwargs):
+        for field in self._fields:
+            setattr(self, field, kwargs.pop(field, None))
+        self.extra = kwargs or None
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(**d)
+
+    def _present(self, field):
+        if field in self._required:
+            return True
+        return bool(getattr(self, field))
+
+    def iteritems(self):
+        for field in self._fields:
+            if self._present(field):
+                yield field, getattr(self, field)
+        if self.extra:
+            for item in self.extra.iteritems():
+                yield item
+
+    def items(self):
+        return list(self.iteritems())
+
+    def keys(self):
+        return [k for k, v in self.iteritems()]
+
+    def values(self):
+        return [v for k, v in self.iteritems()]
+
+    def __iter__(self):
+        for k, v in self.iteritems():
+            yield k
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __getitem__(self, key):
+        if key in self._fields:
+            if self._present(key):
+                return getattr(self, key)
+        elif self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    has_key = __contains__
+
+    def to_dict(self):
+        out = {}
+        for k, v in self.iteritems():
+            if isinstance(v, Record):
+                v = v.to_dict()
+            elif isinstance(v, list):
+                v = [i.to_dict() if isinstance(i, Record) else i for i in v]
+            out[k] = v
+        return out
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            other = other.to_dict()
+        elif not isinstance(other, dict):
+            return NotImplemented
+        return self.to_dict() == other
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __getstate__(self):
+        return tuple(getattr(self, f) for f in self._fields) + (self.extra,)
+
+    def __setstate__(self, state):
+        for field, value in zip(self._fields, state):
+            setattr(self, field, value)
+        self.extra = state[-1]
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join(
+            '%s=%r' % item for item in self.iteritems()))
+
+class Citation(Record):
+    _fields = ('title', 'creator', 'source', 'date', 'publisher',
+               'creatorFirst', 'creatorMiddle', 'creatorLast', 'volume',
+               'issue', 'spage', 'doi', 'pmid', 'publicationPlace',
+               'institution', 'advisor', 'patentNumber', 'issn', 'eissn',
+               'isbn')
+    __slots__ = _fields
+
+class HoldingData(Record):
+    _fields = ('providerId', 'providerName', 'databaseId', 'databaseName',
+               'startDate', 'endDate')
+    _required = ('providerId', 'providerName', 'databaseId', 'databaseName')
+    __slots__ = _fields
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(**dict((k, _share(v)) for k, v in d.iteritems()))
+
+class LinkGroup(Record):
+    _fields = ('type', 'holdingData', 'url')
+    _required = _fields
+    __slots__ = _fields
+
+    @classmethod
+    def from_dict(cls, d):
+        d = dict(d)
+        d['type'] = _share(d.get('type'))
+        holding = d.get('holdingData')
+        if holding is not None:
+            d['holdingData'] = HoldingData.from_dict(holding)
+        url = d.get('url')
+        if url is not None:
+            d['url'] = dict((_share(k), v) for k, v in url.iteritems())
+        return cls(**d)
+
+class Result(Record):
+    _fields = ('format', 'citation', 'linkGroups')
+    _required = _fields
+    __slots__ = _fields
+
+    @classmethod
+    def from_dict(cls, d):
+        d = dict(d)
+        d['format'] = _share(d.get('format'))
+        if d.get('citation') is not None:
+            d['citation'] = Citation.from_dict(d['citation'])
+        if d.get('linkGroups') is not None:
+            d['linkGroups'] = [LinkGroup.from_dict(g) for g in d['linkGroups']]
+        return cls(**d)
+
+class SersolData(Record):
+    """
+    The whole response.  echoedQuery and diagnostics are left as
+    dictionaries since there is only one of each per response.
+    """
+    _fields = ('version', 'echoedQuery', 'dbDate', 'results', 'diagnostics')
+    _required = ('version', 'echoedQuery', 'dbDate', 'results')
+    __slots__ = _fields
+
+    @classmethod
+    def from_dict(cls, d):
+        d = dict(d)
+        d['version'] = _share(d.get('version'))
+        if d.get('results') is not None:
+            d['results'] = [Result.from_dict(r) for r in d['results']]
+        return cls(**d)
+
+def compact(data):
+    """
+    Convert get_sersol_data output to a SersolData, leaving one that is
+    already converted alone.
+    """
+    if isinstance(data, SersolData):
+        return data
+    return SersolData.from_dict(data)
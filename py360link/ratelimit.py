@@ -0,0 +1,156 @@
+"""
+Client side rate limiting for the 360Link API, which throttles per key.
+
+A RateLimiter combines a token bucket, capping requests per second, with
+an adaptive (AIMD) limit on requests in flight.  The in-flight limit grows
+by about one for every limit successful requests and is cut by the
+backoff factor when requests fail or run slower than latency_target.
+Callers waiting for a slot are served in priority order, so interactive
+lookups go ahead of bulk ones on the same key.
+
+Share one limiter per key with limiter_for and give each client a
+priority:
+
+    limiter = limiter_for(key, rate=20, max_concurrency=16)
+    web = Link360Client(key, limiter=limiter, priority=INTERACTIVE)
+    batch = Link360Client(key, limiter=limiter, priority=BULK)
+"""
+import heapq
+import itertools
+import threading
+import time
+
+from link360 import Link360Timeout
+from resilience import is_transient
+
+#Priority classes; lower values go first.
+INTERACTIVE = 0
+BULK = 10
+
+class RateLimiter(object):
+    """
+    rate is in requests per second with bursts of up to burst requests;
+    None turns the token bucket off.  The in-flight limit starts at
+    initial_concurrency and stays between min_concurrency and
+    max_concurrency.  It is cut at most once every cooldown seconds.
+    """
+    def __init__(self, rate=None, burst=None, max_concurrency=32,
+                 min_concurrency=1, initial_concurrency=None,
+                 latency_target=None, backoff=0.5, cooldown=1.0,
+                 counts_as_failure=is_transient):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate or 1))
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = float(initial_concurrency or max_concurrency)
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self.cooldown = cooldown
+        self.counts_as_failure = counts_as_failure
+        self.in_flight = 0
+        self.throttled = 0
+        self._tokens = float(self.burst)
+        self._updated = time.time()
+        self._last_decrease = 0
+        self._waiters = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    def _refill(self, now):
+        if self.rate is not None:
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, priority=INTERACTIVE, timeout=None):
+        """
+        Wait for a request slot.  Raises Link360Timeout if none is free
+        within timeout seconds.  Call release() when the request is done.
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        ticket = (priority, next(self._seq))
+        with self._cond:
+            heapq.heappush(self._waiters, ticket)
+            waited = False
+            try:
+                while True:
+                    now = time.time()
+                    self._refill(now)
+                    wait = None
+                    if (self._waiters[0] == ticket and
+                            self.in_flight < int(self.limit)):
+                        if self.rate is None or self._tokens >= 1:
+                            break
+                        wait = (1 - self._tokens) / self.rate
+                    if deadline is not None:
+                        remaining = deadline - now
+                        if remaining <= 0:
+                            raise Link360Timeout('No 360Link request slot free '
+                                                 'after %s seconds.' % timeout)
+                        wait = min(wait or remaining, remaining)
+                    waited = True
+                    self._cond.wait(wait)
+            except:
+                self._waiters.remove(ticket)
+                heapq.heapify(self._waiters)
+                self._cond.notify_all()
+                raise
+            heapq.heappop(self._waiters)
+            if self.rate is not None:
+                self._tokens -= 1
+            self.in_flight += 1
+            if waited:
+                self.throttled += 1
+            #Let the next waiter check whether it can go too.
+            self._cond.notify_all()
+
+    def release(self, latency=None, error=None):
+        """
+        Return a slot, reporting how long the request took and any error
+        so the in-flight limit can adapt.
+        """
+        with self._cond:
+            self.in_flight -= 1
+            slow = (latency is not None and self.latency_target is not None
+                    and latency > self.latency_target)
+            failed = error is not None and self.counts_as_failure(error)
+            if failed or slow:
+                now = time.time()
+                if now - self._last_decrease >= self.cooldown:
+                    self.limit = max(self.min_concurrency, self.limit * self.backoff)
+                    self._last_decrease = now
+            elif error is None:
+                self.limit = min(self.max_concurrency, self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
+
+    def call(self, fn, *args, **kwargs):
+        """
+        Run fn in a slot at the given priority keyword (default
+        INTERACTIVE), reporting its outcome.
+        """
+        priority = kwargs.pop('priority', INTERACTIVE)
+        self.acquire(priority)
+        start = time.time()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception, e:
+            self.release(time.time() - start, e)
+            raise
+        self.release(time.time() - start)
+        return result
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def limiter_for(key, **kwargs):
+    """
+    The shared RateLimiter for a 360Link key, created with kwargs the first
+    time it is asked for.
+    """
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = _limiters[key] = RateLimiter(**kwargs)
+        return limiter
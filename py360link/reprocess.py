@@ -0,0 +1,273 @@
+"""
+Reconvert archived raw 360Link XML responses on all cores.
+
+When the conversion or OpenURL building changes, saved responses can be
+run through it again instead of being looked up.  Parsing and converting
+is CPU bound, so the responses are handed to a pool of processes in
+chunks and a JSON record is written per response, in input order:
+
+    {"source": "2011/06/01.tar.gz:r123.xml", "data": {...},
+     "openurl": "...", "oclc_number": "...", "error": null}
+
+A response that fails to parse or resolve, or a file or archive that
+can't be read, gets a record with the error rather than stopping the run.
+
+Sources can be .xml and .xml.gz files, directories of them, and .tar,
+.tar.gz, .tgz, .tar.bz2 and .zip archives:
+
+    py360link-reprocess archive/ 2012.tar.gz -o derived.jsonl --processes 16
+"""
+import argparse
+import gzip
+import json
+import multiprocessing
+import os
+import Queue
+import sys
+import tarfile
+import zipfile
+from collections import deque
+from io import BytesIO
+
+from lxml import etree
+
+from link360 import Link360JSON, Resolved
+
+XML_SUFFIXES = ('.xml', '.xml.gz')
+TAR_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.bz2')
+ZIP_SUFFIXES = ('.zip',)
+
+def _gunzip(name, body):
+    if name.endswith('.gz'):
+        return gzip.GzipFile(fileobj=BytesIO(body)).read()
+    return body
+
+def _error(e):
+    return '%s: %s' % (e.__class__.__name__, e)
+
+def _iter_plain(path):
+    with open(path, 'rb') as f:
+        yield path, f.read()
+
+def _iter_tar(path):
+    with tarfile.open(path) as archive:
+        for member in archive:
+            if member.isfile() and member.name.endswith(XML_SUFFIXES):
+                body = archive.extractfile(member).read()
+                yield '%s:%s' % (path, member.name), body
+
+def _iter_zip(path):
+    with zipfile.ZipFile(path) as archive:
+        for name in archive.namelist():
+            if name.endswith(XML_SUFFIXES):
+                yield '%s:%s' % (path, name), archive.read(name)
+
+def _iter_file(path):
+    if path.endswith(TAR_SUFFIXES):
+        sources = _iter_tar(path)
+    elif path.endswith(ZIP_SUFFIXES):
+        sources = _iter_zip(path)
+    else:
+        sources = _iter_plain(path)
+    try:
+        for source in sources:
+            yield source
+    except Exception, e:
+        #A file or archive that can't be opened or is corrupt part way
+        #through ends with a record for the file itself.
+        yield path, e
+
+def iter_sources(paths):
+    """
+    Yield (name, body) for each saved response under paths.  Directories
+    are walked in sorted order for .xml files and archives; files given
+    directly are read whatever their name.
+
+    body is the raw content, still gzipped for names ending in .gz, so
+    decompressing happens in the workers.  For a file or archive that
+    can't be read it is the exception raised, which convert records.
+    """
+    for path in paths:
+        if not os.path.isdir(path):
+            for source in _iter_file(path):
+                yield source
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if name.endswith(XML_SUFFIXES + TAR_SUFFIXES + ZIP_SUFFIXES):
+                    for source in _iter_file(os.path.join(root, name)):
+                        yield source
+
+def _record(source, error=None):
+    return {
+        'source': source,
+        'data': None,
+        'openurl': None,
+        'oclc_number': None,
+        'error': error,
+    }
+
+def convert(name, body):
+    """
+    Record for one saved response, gunzipping body first if name ends
+    with .gz.
+    """
+    out = _record(name)
+    if isinstance(body, Exception):
+        out['error'] = _error(body)
+        return out
+    try:
+        doc = etree.parse(BytesIO(_gunzip(name, body)))
+        out['data'] = Link360JSON(doc).convert()
+        resolved = Resolved(out['data'])
+        out['openurl'] = resolved.openurl
+        out['oclc_number'] = resolved.oclc_number
+    except Exception, e:
+        out['error'] = _error(e)
+    return out
+
+def _convert_chunk(chunk):
+    """
+    Convert a chunk in a worker process.  Records are sent back as JSON
+    lines so encoding happens in the workers too.
+
+    This never raises: the pool has no way to report a failed chunk to the
+    unordered reader, which would wait for it forever.
+    """
+    lines = []
+    for name, body in chunk:
+        try:
+            record = convert(name, body)
+            line = json.dumps(record)
+        except Exception, e:
+            #e.g. a name from an archive that isn't UTF-8.
+            record = _record(name.decode('utf-8', 'replace'), _error(e))
+            line = json.dumps(record)
+        lines.append((name, record['error'], line))
+    return lines
+
+class ReprocessResult(object):
+    """
+    Outcome for one saved response: its source name, the JSON line written
+    for it and the error message if it failed.
+    """
+    __slots__ = ('source', 'line', 'error')
+
+    def __init__(self, source, line, error=None):
+        self.source = source
+        self.line = line
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    @property
+    def record(self):
+        return json.loads(self.line)
+
+    def __repr__(self):
+        if self.ok:
+            return '<ReprocessResult %s ok>' % self.source
+        return '<ReprocessResult %s %s>' % (self.source, self.error)
+
+def _chunks(sources, size):
+    chunk = []
+    for source in sources:
+        chunk.append(source)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def iter_reprocess(sources, processes=None, chunk_size=100, ordered=True):
+    """
+    Convert sources, (name, body) pairs such as from iter_sources, on a pool
+    of processes (default one per CPU) and yield a ReprocessResult for each.
+
+    Sources are sent chunk_size at a time and read only as chunks finish,
+    at most two per process ahead, so memory stays bounded for any number
+    of archives.  With ordered=False results come back as chunks complete.
+    """
+    processes = processes or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes)
+    chunks = _chunks(sources, chunk_size)
+    window = processes * 2
+    try:
+        if ordered:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(pool.apply_async(_convert_chunk, (chunk,)))
+                if len(pending) >= window:
+                    for line in pending.popleft().get():
+                        yield ReprocessResult(line[0], line[2], line[1])
+            while pending:
+                for line in pending.popleft().get():
+                    yield ReprocessResult(line[0], line[2], line[1])
+        else:
+            done = Queue.Queue()
+            running = 0
+            for chunk in chunks:
+                pool.apply_async(_convert_chunk, (chunk,), callback=done.put)
+                running += 1
+                while running >= window:
+                    #A timeout keeps the wait interruptible with Ctrl-C.
+                    lines = done.get(timeout=sys.maxint)
+                    running -= 1
+                    for line in lines:
+                        yield ReprocessResult(line[0], line[2], line[1])
+            while running:
+                lines = done.get(timeout=sys.maxint)
+                running -= 1
+                for line in lines:
+                    yield ReprocessResult(line[0], line[2], line[1])
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Reconvert saved 360Link XML responses to JSON records.')
+    parser.add_argument('paths', nargs='+',
+                        help='xml files, directories or archives of them')
+    parser.add_argument('-o', '--output', default='-',
+                        help='JSONL output file (default stdout)')
+    parser.add_argument('-p', '--processes', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='worker processes (default one per CPU)')
+    parser.add_argument('--chunk-size', type=int, default=100,
+                        help='responses sent to a worker at a time (default 100)')
+    parser.add_argument('--unordered', action='store_true',
+                        help='write records as chunks finish, not in input order')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.output == '-':
+        outfile = sys.stdout
+    else:
+        outfile = open(args.output, 'w')
+    ok = failed = 0
+    try:
+        for result in iter_reprocess(iter_sources(args.paths), args.processes,
+                                     args.chunk_size, not args.unordered):
+            outfile.write(result.line + '\n')
+            if result.ok:
+                ok += 1
+            else:
+                failed += 1
+                sys.stderr.write('%s: %s\n' % (result.source, result.error))
+    finally:
+        outfile.flush()
+        if outfile is not sys.stdout:
+            outfile.close()
+    sys.stderr.write('%d converted, %d failed\n' % (ok, failed))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
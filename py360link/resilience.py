@@ -0,0 +1,197 @@
+"""
+Policies for riding out a slow or failing 360Link: retries with jittered
+exponential backoff, hedged requests and a circuit breaker.  Pass them to
+Link360Client:
+
+    client = Link360Client(key, timeout=2,
+                           retry=RetryPolicy(attempts=3),
+                           hedge=HedgePolicy(percentile=95),
+                           breaker=CircuitBreaker(failure_threshold=10))
+"""
+import httplib
+import random
+import socket
+import threading
+import time
+import urllib2
+from collections import deque
+
+from link360 import CircuitOpen
+
+def is_transient(error):
+    """
+    True for errors worth retrying: timeouts, connection problems and 5xx
+    responses.  4xx responses and other errors are not.
+    """
+    if isinstance(error, urllib2.HTTPError):
+        return error.code >= 500
+    return isinstance(error, (socket.error, httplib.HTTPException,
+                              urllib2.URLError))
+
+class RetryPolicy(object):
+    """
+    Retry transient failures up to attempts times in all.  The wait before
+    retry n is a random time up to min(max_backoff, backoff * 2 ** n)
+    seconds ("full jitter"), which spreads retries from many clients out.
+    """
+    def __init__(self, attempts=3, backoff=0.1, max_backoff=2.0,
+                 retry_on=is_transient):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retry_on = retry_on
+
+    def delay(self, retry):
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** retry))
+
+    def call(self, fn, *args, **kwargs):
+        retry = 0
+        while True:
+            try:
+                return fn(*args, **kwargs)
+            except Exception, e:
+                retry += 1
+                if retry >= self.attempts or not self.retry_on(e):
+                    raise
+            time.sleep(self.delay(retry - 1))
+
+class HedgePolicy(object):
+    """
+    Send a second request if the first hasn't answered within delay
+    seconds and use whichever answers first.  Without a fixed delay, the
+    given percentile of recent response times is used once min_samples
+    responses have been seen.
+    """
+    def __init__(self, delay=None, percentile=95, min_samples=20,
+                 sample_size=500):
+        self.delay = delay
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=sample_size)
+        self.hedged = 0
+
+    def record(self, seconds):
+        self._samples.append(seconds)
+
+    def hedge_delay(self):
+        if self.delay is not None:
+            return self.delay
+        samples = sorted(self._samples)
+        if len(samples) < self.min_samples:
+            return None
+        return samples[int((len(samples) - 1) * self.percentile / 100.0)]
+
+    def call(self, fn, *args, **kwargs):
+        delay = self.hedge_delay()
+        if delay is None:
+            start = time.time()
+            result = fn(*args, **kwargs)
+            self.record(time.time() - start)
+            return result
+        return _Hedge(self, fn, args, kwargs).run(delay)
+
+class _Hedge(object):
+    def __init__(self, policy, fn, args, kwargs):
+        self.policy = policy
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.done = threading.Condition()
+        self.result = None
+        self.errors = []
+        self.started = 0
+        self.finished = False
+
+    def _attempt(self):
+        start = time.time()
+        try:
+            result = self.fn(*self.args, **self.kwargs)
+        except Exception, e:
+            with self.done:
+                self.errors.append(e)
+                self.done.notify_all()
+            return
+        self.policy.record(time.time() - start)
+        with self.done:
+            if not self.finished:
+                self.finished = True
+                self.result = result
+            self.done.notify_all()
+
+    def _start(self):
+        self.started += 1
+        thread = threading.Thread(target=self._attempt)
+        thread.daemon = True
+        thread.start()
+
+    def run(self, delay):
+        with self.done:
+            self._start()
+            self.done.wait(delay)
+            if not self.finished and not self.errors:
+                self.policy.hedged += 1
+                self._start()
+            while not self.finished and len(self.errors) < self.started:
+                self.done.wait()
+            if self.finished:
+                return self.result
+            raise self.errors[-1]
+
+class CircuitBreaker(object):
+    """
+    Fail fast with CircuitOpen after failure_threshold transient failures in
+    a row.  After reset_timeout seconds one trial request is let through;
+    success closes the circuit and failure opens it again.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30,
+                 counts_as_failure=is_transient):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.counts_as_failure = counts_as_failure
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def _allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if (self.state == self.OPEN and
+                    time.time() - self.opened_at >= self.reset_timeout):
+                self.state = self.HALF_OPEN
+                return True
+            self.rejected += 1
+            return False
+
+    def _success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def _failure(self):
+        with self._lock:
+            self.failures += 1
+            if (self.state == self.HALF_OPEN or
+                    self.failures >= self.failure_threshold):
+                self.state = self.OPEN
+                self.opened_at = time.time()
+
+    def call(self, fn, *args, **kwargs):
+        if not self._allow():
+            raise CircuitOpen('360Link circuit is open; not sending request.')
+        try:
+            result = fn(*args, **kwargs)
+        except Exception, e:
+            if self.counts_as_failure(e):
+                self._failure()
+            elif self.state == self.HALF_OPEN:
+                self._success()
+            raise
+        self._success()
+        return result
@@ -7,5 +7,11 @@ from setuptools import setup, find_packages
 setup(name='py360link',
     version='1',
     packages = find_packages(),
-    test_suite = 'py360link.test'
+    test_suite = 'py360link.test',
+    entry_points = {
+        'console_scripts': [
+            'py360link-resolve = py360link.cli:main',
+            'py360link-reprocess = py360link.reprocess:main',
+        ],
+    },
 )
@@ -143,6 +143,1016 @@ class TestFirstSearchArticleLookup(unittest.TestCase):
        
         
 
+#A small two result response for tests that don't need the live API.
+SAMPLE_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<ssopenurl:openURLResponse xmlns:ssopenurl="http://xml.serialssolutions.com/ns/openurl/v1.0" xmlns:dc="http://purl.org/dc/elements/1.1/">
+  <ssopenurl:version>1.0</ssopenurl:version>
+  <ssopenurl:echoedQuery timeStamp="2011-06-01T10:00:00-04:00">
+    <ssopenurl:queryString>isbn=9780394565279&amp;rfe_dat=%3Caccessionnumber%3E17803510%3C%2Faccessionnumber%3E&amp;sid=FirstSearch%3AWorldCat</ssopenurl:queryString>
+    <ssopenurl:library id="ABCDE"><ssopenurl:name>Brown University</ssopenurl:name></ssopenurl:library>
+  </ssopenurl:echoedQuery>
+  <ssopenurl:results dbDate="2011-05-31">
+    <ssopenurl:result format="book">
+      <ssopenurl:citation>
+        <dc:title>The risk pool</dc:title>
+        <dc:creator>Russo, Richard</dc:creator>
+        <dc:date>1988</dc:date>
+        <ssopenurl:isbn>9780394565279</ssopenurl:isbn>
+      </ssopenurl:citation>
+      <ssopenurl:linkGroups>
+        <ssopenurl:linkGroup type="holding">
+          <ssopenurl:holdingData>
+            <ssopenurl:providerId>PRVEBR</ssopenurl:providerId>
+            <ssopenurl:providerName>ebrary</ssopenurl:providerName>
+            <ssopenurl:databaseId>EBR</ssopenurl:databaseId>
+            <ssopenurl:databaseName>ebrary Academic Complete</ssopenurl:databaseName>
+            <ssopenurl:normalizedData><ssopenurl:startDate>1988-01-01</ssopenurl:startDate></ssopenurl:normalizedData>
+          </ssopenurl:holdingData>
+          <ssopenurl:url type="book">http://site.ebrary.com/id/10001</ssopenurl:url>
+        </ssopenurl:linkGroup>
+      </ssopenurl:linkGroups>
+    </ssopenurl:result>
+    <ssopenurl:result format="book">
+      <ssopenurl:citation>
+        <dc:title>The risk pool (Vintage ed.)</dc:title>
+        <ssopenurl:isbn>9780679753834</ssopenurl:isbn>
+      </ssopenurl:citation>
+    </ssopenurl:result>
+  </ssopenurl:results>
+</ssopenurl:openURLResponse>
+"""
+
+def sample_doc():
+    from lxml import etree
+    return etree.ElementTree(etree.fromstring(SAMPLE_XML))
+
+class TestLink360JSON(unittest.TestCase):
+    """
+    Convert a stored response without calling the API.
+    """
+    def setUp(self):
+        from py360link import Link360JSON
+        self.data = Link360JSON(sample_doc()).convert()
+
+    def test_header(self):
+        self.assertEqual(self.data['version'], '1.0')
+        self.assertEqual(self.data['dbDate'], '2011-05-31')
+        self.assertEqual(self.data['echoedQuery']['library']['id'], 'ABCDE')
+        self.assertFalse('diagnostics' in self.data)
+
+    def test_citation_per_result(self):
+        first, second = self.data['results']
+        self.assertEqual(first['citation']['title'], 'The risk pool')
+        self.assertEqual(first['citation']['isbn'], ['9780394565279'])
+        self.assertEqual(second['citation']['title'], 'The risk pool (Vintage ed.)')
+        self.assertEqual(second['citation']['isbn'], ['9780679753834'])
+        self.assertFalse('creator' in second['citation'])
+
+    def test_link_groups_per_result(self):
+        first, second = self.data['results']
+        self.assertEqual(len(first['linkGroups']), 1)
+        self.assertEqual(second['linkGroups'], [])
+        group = first['linkGroups'][0]
+        self.assertEqual(group['type'], 'holding')
+        self.assertEqual(group['url'], {'book': 'http://site.ebrary.com/id/10001'})
+        self.assertEqual(group['holdingData']['startDate'], '1988-01-01')
+        self.assertFalse('endDate' in group['holdingData'])
+
+class TestLazySersolData(unittest.TestCase):
+    """
+    The lazy view should convert only what is read and match the full
+    conversion.
+    """
+    def setUp(self):
+        from py360link import LazySersolData, Link360JSON
+        doc = sample_doc()
+        self.view = LazySersolData(doc)
+        self.data = Link360JSON(doc).convert()
+
+    def test_on_demand(self):
+        first = self.view['results'][0]
+        self.assertEqual(first['linkGroups'][0]['url'],
+                         {'book': 'http://site.ebrary.com/id/10001'})
+        self.assertEqual(first['citation']['isbn'], ['9780394565279'])
+        self.assertFalse('holdingData' in first['linkGroups'][0]._values)
+        self.assertEqual(first['citation']._values.keys(), ['isbn'])
+        self.assertFalse('doi' in first['citation'])
+        self.assertFalse('diagnostics' in self.view)
+
+    def test_materialize(self):
+        self.view['results'][1]['citation'].get('title')
+        materialized = self.view.materialize()
+        self.assertEqual(materialized, self.data)
+        self.assertEqual(type(materialized['results'][0]['citation']), dict)
+        self.assertEqual(self.view, self.data)
+
+    def test_resolved(self):
+        from py360link import Resolved
+        self.assertEqual(Resolved(self.view).openurl,
+                         Resolved(self.data).openurl)
+
+    def test_get_sersol_data(self):
+        from py360link import LazySersolData, LRUCache, get_sersol_data
+        cache = LRUCache()
+        query = 'isbn=9780394565279'
+        view = get_sersol_data(query, client=SampleClient(), cache=cache,
+                               lazy=True)
+        self.assertTrue(isinstance(view, LazySersolData))
+        #The cache holds plain data, not the view.
+        cached = get_sersol_data(query, client=SampleClient(), cache=cache,
+                                 lazy=True)
+        self.assertEqual(type(cached), dict)
+        self.assertEqual(cached['results'], self.data['results'])
+        self.assertEqual(cached['echoedQuery']['queryString'], query)
+
+class TestLink360Stream(unittest.TestCase):
+    """
+    Streaming conversion should match the full conversion.
+    """
+    def setUp(self):
+        from StringIO import StringIO
+        from py360link import Link360Stream
+        self.stream = Link360Stream(StringIO(SAMPLE_XML))
+
+    def test_results(self):
+        from py360link import Link360JSON
+        data = Link360JSON(sample_doc()).convert()
+        self.assertEqual(list(self.stream.results()), data['results'])
+        self.assertEqual(self.stream.info['echoedQuery'], data['echoedQuery'])
+        self.assertEqual(self.stream.info['dbDate'], '2011-05-31')
+
+    def test_events(self):
+        kinds = [kind for kind, value in self.stream]
+        self.assertEqual(kinds, ['result', 'linkGroup', 'result'])
+
+class TestCache(unittest.TestCase):
+    def test_lru(self):
+        from py360link import LRUCache
+        cache = LRUCache(maxsize=2)
+        cache.set('a', {'x': 1})
+        cache.set('b', {'x': 2})
+        self.assertEqual(cache.get('a'), {'x': 1})
+        cache.set('c', {'x': 3})
+        #b was least recently used
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.stats.as_dict()['hits'], 1)
+        self.assertEqual(cache.stats.misses, 1)
+        self.assertEqual(cache.stats.evictions, 1)
+
+    def test_ttl(self):
+        from py360link import LRUCache
+        cache = LRUCache(ttl=-1)
+        cache.set('a', {'x': 1})
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.stats.evictions, 1)
+
+    def test_sqlite(self):
+        from py360link import SqliteCache, Link360JSON
+        cache = SqliteCache(':memory:', maxsize=1)
+        data = Link360JSON(sample_doc()).convert()
+        cache.set('a', data)
+        self.assertEqual(cache.get('a'), data)
+        cache.set('b', data)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.stats.evictions, 1)
+
+    def test_hit_keeps_own_query(self):
+        from py360link import LRUCache, get_sersol_data
+        cache = LRUCache()
+        first = get_sersol_data('id=pmid:1&sid=A', client=SampleClient(),
+                                cache=cache)
+        data = get_sersol_data('sid=B&rfr_id=info:sid/zotero&pmid=1',
+                               client=SampleClient(), cache=cache)
+        resolved = Resolved(data)
+        self.assertEqual(resolved.query_dict['sid'], ['B'])
+        self.assertTrue('rfr_id=info%3Asid%2Fzotero' in resolved.openurl)
+        #The cached data itself isn't changed.
+        self.assertEqual(Resolved(first).query_dict['sid'],
+                         ['FirstSearch:WorldCat'])
+        self.assertTrue(data['results'] is first['results'])
+
+    def test_hit_keeps_echo(self):
+        from py360link import LRUCache, get_sersol_data
+        cache = LRUCache()
+        client = EchoClient()
+        results = [get_sersol_data(query, client=client, cache=cache)
+                   for query in ('pmid=1&sid=A', 'pmid=1&sid=A', 'sid=B&pmid=1')]
+        self.assertEqual(len(client.queries), 1)
+        for data in results:
+            qdict = Resolved(data).query_dict
+            self.assertEqual(qdict['url_ver'], ['Z39.88-2004'])
+            self.assertEqual(qdict['version'], ['1.0'])
+            self.assertEqual(qdict['pmid'], ['1'])
+        #A repeat of the same query gets the stored data unchanged.
+        self.assertTrue(results[1] is results[0])
+        self.assertEqual(Resolved(results[2]).query_dict['sid'], ['B'])
+
+class TestCodec(unittest.TestCase):
+    def setUp(self):
+        from py360link import Link360JSON
+        self.data = Link360JSON(sample_doc()).convert()
+
+    def test_round_trip(self):
+        from py360link import codec, compact
+        blob = codec.dumps(self.data)
+        self.assertEqual(codec.loads(blob), self.data)
+        self.assertEqual(codec.loads(codec.dumps(compact(self.data))),
+                         self.data)
+        #Data that doesn't fit the packed form is kept as is.
+        self.data['results'][0]['linkGroups'][0]['extra'] = 1
+        self.assertEqual(codec.loads(codec.dumps(self.data)), self.data)
+
+    def test_load_resolved(self):
+        from py360link import Resolved, codec
+        resolved = codec.load_resolved(codec.dumps(self.data))
+        self.assertEqual(sorted(resolved.openurl_pairs()),
+                         sorted(Resolved(self.data).openurl_pairs()))
+
+    def test_stale(self):
+        import struct
+        from py360link import StaleEntry, codec
+        blob = codec.dumps(self.data)
+        old = struct.pack('>3sB', codec.MAGIC, codec.SCHEMA_VERSION - 1)
+        self.assertRaises(StaleEntry, codec.loads, old + blob[4:])
+        self.assertRaises(StaleEntry, codec.loads, '{"version": "1.0"}')
+
+    def test_sqlite_cache(self):
+        from py360link import SqliteCache, codec
+        cache = SqliteCache(':memory:', codec=codec)
+        cache.set('k', self.data)
+        self.assertEqual(cache.get('k'), self.data)
+        #Entries the codec can't read count as misses and are removed.
+        cache._conn.execute("UPDATE sersol_cache SET value = '{}'")
+        self.assertEqual(cache.get('k'), None)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.stats.misses, 1)
+        cache.close()
+
+class TestCanonicalQuery(unittest.TestCase):
+    def test_id_forms(self):
+        from py360link import canonicalize_query
+        expected = canonicalize_query('rft_id=info:pmid/19282400')
+        self.assertEqual(canonicalize_query('id=pmid:19282400&sid=Entrez:PubMed'), expected)
+        self.assertEqual(canonicalize_query('?pmid=19282400&rfr_id=info:sid/x'), expected)
+
+    def test_order_and_doi_case(self):
+        from py360link import canonicalize_query
+        self.assertEqual(
+            canonicalize_query('id=doi:10.1016/J.NEUROIMAGE&date=2009&id=doi:'),
+            canonicalize_query('date=2009&rft_id=info:doi/10.1016/j.neuroimage&url_ver=Z39.88-2004'))
+
+    def test_single_flight(self):
+        import threading
+        from py360link import SingleFlight
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        def work():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return 'done'
+        results = []
+        leader = threading.Thread(target=lambda: results.append(flight.do('k', work)))
+        leader.start()
+        started.wait()
+        follower = threading.Thread(target=lambda: results.append(flight.do('k', work)))
+        follower.start()
+        while flight.shared == 0:
+            pass
+        release.set()
+        leader.join()
+        follower.join()
+        self.assertEqual(results, ['done', 'done'])
+        self.assertEqual(len(calls), 1)
+
+    def test_coalesced_keeps_own_query(self):
+        import threading
+        from py360link import INFLIGHT, get_sersol_data
+        release = threading.Event()
+        class SlowClient(SampleClient):
+            def get_response(self, query):
+                release.wait()
+                return SampleClient.get_response(self, query)
+        client = SlowClient()
+        results = {}
+        def lookup(sid):
+            results[sid] = get_sersol_data('pmid=1&sid=%s' % sid,
+                                           client=client, coalesce=True)
+        threads = [threading.Thread(target=lookup, args=(sid,))
+                   for sid in ('A', 'B')]
+        shared = INFLIGHT.shared
+        for thread in threads:
+            thread.start()
+        while INFLIGHT.shared == shared:
+            pass
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(client.queries), 1)
+        leader = client.queries[0][-1]
+        follower = 'A' if leader == 'B' else 'B'
+        self.assertEqual(Resolved(results[follower]).query_dict['sid'],
+                         [follower])
+
+class SampleClient(object):
+    """
+    Stands in for Link360Client, answering every query with SAMPLE_XML.
+    """
+    key = 'sample'
+
+    def __init__(self, fail=(), delay=0):
+        self.fail = fail
+        self.delay = delay
+        self.queries = []
+
+    def get_response(self, query):
+        import time
+        self.queries.append(query)
+        time.sleep(self.delay)
+        if query in self.fail:
+            raise IOError('Unable to reach 360Link.')
+        return sample_doc()
+
+    def close(self):
+        pass
+
+class EchoClient(SampleClient):
+    """
+    SampleClient that echoes the query sent, as 360Link does, including
+    the version parameters added to every request.
+    """
+    def get_response(self, query):
+        from py360link.link360 import NS, SERSOL_PATH
+        doc = SampleClient.get_response(self, query)
+        echo = doc.find('//{%s}queryString' % NS['ss'])
+        echo.text = SERSOL_PATH.split('?', 1)[1] + '&' + query.lstrip('?')
+        return doc
+
+class LocalServer(object):
+    """
+    Answers every request with SAMPLE_XML on kept-alive connections.
+    close_after closes a connection after that many responses, as servers
+    do with idle ones.  delay is slept before answering all but the first
+    request on a connection.
+    """
+    def __init__(self, close_after=None, delay=0):
+        import socket, threading
+        self.close_after = close_after
+        self.delay = delay
+        self.connections = 0
+        self.requests = 0
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.host = '127.0.0.1:%d' % self.sock.getsockname()[1]
+        thread = threading.Thread(target=self._serve)
+        thread.daemon = True
+        thread.start()
+
+    def _serve(self):
+        import socket, threading
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except socket.error:
+                return
+            self.connections += 1
+            thread = threading.Thread(target=self._handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _handle(self, conn):
+        import socket, time
+        f = conn.makefile('rb')
+        served = 0
+        try:
+            while self.close_after is None or served < self.close_after:
+                if not f.readline():
+                    break
+                while f.readline() not in ('\r\n', '\n', ''):
+                    pass
+                self.requests += 1
+                if served:
+                    time.sleep(self.delay)
+                conn.sendall('HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s'
+                             % (len(SAMPLE_XML), SAMPLE_XML))
+                served += 1
+        except socket.error:
+            pass
+        finally:
+            f.close()
+            conn.close()
+
+    def stop(self):
+        self.sock.close()
+
+class TestLink360Client(unittest.TestCase):
+    def test_reuse(self):
+        from py360link import Link360Client
+        from py360link.metrics import Trace
+        server = LocalServer()
+        client = Link360Client('sample', host=server.host)
+        traces = [Trace('lookup'), Trace('lookup')]
+        for trace in traces:
+            self.assertEqual(client.fetch('isbn=1', trace=trace), SAMPLE_XML)
+        self.assertEqual(server.connections, 1)
+        stages = [[name for name, seconds in t.stages] for t in traces]
+        self.assertTrue('connect' in stages[0])
+        self.assertFalse('connect' in stages[1])
+        client.close()
+        server.stop()
+
+    def test_pool_size(self):
+        import threading
+        from py360link import Link360Client
+        server = LocalServer()
+        client = Link360Client('sample', host=server.host, pool_size=1)
+        threads = [threading.Thread(target=client.fetch, args=('isbn=1',))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(server.requests, 4)
+        self.assertEqual(server.connections, 1)
+        client.close()
+        server.stop()
+
+    def test_stale_connection(self):
+        import time
+        from py360link import Link360Client
+        server = LocalServer(close_after=1)
+        client = Link360Client('sample', host=server.host)
+        client.fetch('isbn=1')
+        time.sleep(0.05)
+        #The idle connection was closed by the server, so the request is
+        #sent again on a new one.
+        self.assertEqual(client.fetch('isbn=1'), SAMPLE_XML)
+        self.assertEqual(server.connections, 2)
+        client.close()
+        server.stop()
+
+    def test_timeout_not_resent(self):
+        import socket, time
+        from py360link import Link360Client
+        server = LocalServer(delay=0.5)
+        client = Link360Client('sample', host=server.host, timeout=0.2)
+        client.fetch('isbn=1')
+        start = time.time()
+        self.assertRaises(socket.timeout, client.fetch, 'isbn=1')
+        self.assertTrue(time.time() - start < 0.4)
+        self.assertEqual(server.requests, 2)
+        self.assertEqual(server.connections, 1)
+        client.close()
+        server.stop()
+
+class TestAsyncClient(unittest.TestCase):
+    def test_submit(self):
+        from py360link import Link360AsyncClient
+        client = Link360AsyncClient('sample', concurrency=2,
+                                    client=SampleClient(fail=['bad']))
+        done = []
+        good = client.submit('isbn=9780394565279', callback=done.append)
+        bad = client.submit('bad')
+        self.assertEqual(good.result(5)['dbDate'], '2011-05-31')
+        self.assertTrue(isinstance(bad.exception(5), IOError))
+        self.assertRaises(IOError, bad.result)
+        client.close()
+        self.assertEqual(done, [good])
+
+    def test_queue_timeout(self):
+        from py360link import Link360AsyncClient
+        from py360link.link360 import Link360Timeout
+        #timeout is for the HTTP request only, so queued lookups wait.
+        client = Link360AsyncClient('sample', concurrency=1, timeout=0.05,
+                                    client=SampleClient(delay=0.1))
+        futures = [client.submit('isbn=%d' % i) for i in range(3)]
+        self.assertTrue(all(f.exception(5) is None for f in futures))
+        client.queue_timeout = 0.05
+        futures = [client.submit('isbn=%d' % i) for i in range(3)]
+        self.assertEqual(futures[0].exception(5), None)
+        self.assertTrue(isinstance(futures[2].exception(5), Link360Timeout))
+        client.close()
+
+    def test_request_timeout(self):
+        import socket
+        from py360link import Link360AsyncClient, Link360Client
+        server = LocalServer(delay=0.5)
+        client = Link360AsyncClient('sample', concurrency=1,
+                                    client=Link360Client('sample', host=server.host))
+        self.assertEqual(client.submit('isbn=1').exception(5), None)
+        #The timeout applies to this lookup's request on the shared
+        #connection.
+        slow = client.submit('isbn=1', timeout=0.2)
+        self.assertTrue(isinstance(slow.exception(5), socket.timeout))
+        self.assertEqual(client.submit('isbn=1').exception(5), None)
+        self.assertEqual(client.client.timeout, 5)
+        self.assertEqual(server.connections, 2)
+        client.close()
+        server.stop()
+
+class TestResolveMany(unittest.TestCase):
+    def setUp(self):
+        from py360link import Link360AsyncClient
+        self.client = Link360AsyncClient('sample', concurrency=3,
+                                         client=SampleClient(fail=['bad']))
+
+    def tearDown(self):
+        self.client.close()
+
+    def test_ordered(self):
+        from py360link import resolve_many
+        queries = ['isbn=%d' % i for i in range(10)] + ['bad']
+        results = resolve_many(queries, workers=3, client=self.client)
+        self.assertEqual([r.query for r in results], queries)
+        self.assertTrue(all(r.ok for r in results[:-1]))
+        self.assertEqual(results[0].resolved.format, 'book')
+        self.assertFalse(results[-1].ok)
+        self.assertTrue(isinstance(results[-1].error, IOError))
+
+    def test_unordered(self):
+        from py360link import resolve_many
+        queries = ['isbn=%d' % i for i in range(10)]
+        results = resolve_many(queries, workers=3, ordered=False,
+                               client=self.client)
+        self.assertEqual(sorted(r.index for r in results), range(10))
+
+    def test_shared_client(self):
+        from py360link import Link360AsyncClient, resolve_many
+        #Items waiting their turn in the batch don't run into the shared
+        #client's queue timeout.
+        client = Link360AsyncClient('sample', concurrency=2, queue_timeout=0.1,
+                                    client=SampleClient(delay=0.06))
+        queries = ['isbn=%d' % i for i in range(8)]
+        for ordered in (True, False):
+            results = resolve_many(queries, workers=8, ordered=ordered,
+                                   client=client)
+            self.assertEqual([r.error for r in results], [None] * 8)
+        client.close()
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        import os, tempfile
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'run.checkpoint')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dir)
+
+    def test_mark(self):
+        from py360link.cli import Checkpoint
+        checkpoint = Checkpoint()
+        self.assertFalse(checkpoint.resuming)
+        for lineno in (0, 2, 3):
+            checkpoint.mark(lineno)
+        #Only lines done out of order are kept.
+        self.assertEqual(checkpoint.next, 1)
+        self.assertEqual(checkpoint.done, set([2, 3]))
+        self.assertEqual([checkpoint.is_done(i) for i in range(5)],
+                         [True, False, True, True, False])
+        checkpoint.mark(1)
+        self.assertEqual(checkpoint.next, 4)
+        self.assertEqual(checkpoint.done, set())
+        #Saving without a path does nothing.
+        checkpoint.save()
+
+    def test_resume(self):
+        import os
+        from py360link.cli import Checkpoint
+        checkpoint = Checkpoint(self.path)
+        for lineno in (0, 1, 5):
+            checkpoint.mark(lineno)
+        checkpoint.save()
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+        resumed = Checkpoint(self.path)
+        self.assertTrue(resumed.resuming)
+        self.assertEqual(resumed.next, 2)
+        self.assertEqual(resumed.done, set([5]))
+        self.assertTrue(resumed.is_done(5))
+        self.assertFalse(resumed.is_done(2))
+
+    def test_resume_after_kill(self):
+        import json, os, sys
+        from StringIO import StringIO
+        from py360link import Link360AsyncClient, batch, cli
+        def iter_resolve(queries, key=None, ordered=True, **kwargs):
+            client = Link360AsyncClient(key, concurrency=2, client=SampleClient())
+            try:
+                for result in batch.iter_resolve(queries, ordered=ordered,
+                                                 client=client):
+                    yield result
+            finally:
+                client.close()
+        infile = os.path.join(self.dir, 'queries.txt')
+        outfile = os.path.join(self.dir, 'out.jsonl')
+        argv = [infile, '-o', outfile, '-k', 'sample', '-c', self.path,
+                '--checkpoint-every', '2']
+        stderr = sys.stderr
+        cli.iter_resolve, sys.stderr = iter_resolve, StringIO()
+        try:
+            with open(infile, 'w') as f:
+                f.write(''.join('isbn=%d\n' % i for i in range(4)))
+            cli.main(argv)
+            #Killed after another lookup finished, part way through
+            #writing it.
+            with open(outfile, 'a') as f:
+                f.write('{"line": 4, "que')
+            with open(infile, 'a') as f:
+                f.write(''.join('isbn=%d\n' % i for i in range(4, 6)))
+            cli.main(argv)
+        finally:
+            cli.iter_resolve, sys.stderr = batch.iter_resolve, stderr
+        with open(outfile) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(sorted(r['line'] for r in records), range(6))
+        self.assertTrue(all(r['error'] is None for r in records))
+
+    def test_checkpoint_every(self):
+        import sys
+        from StringIO import StringIO
+        from py360link import cli
+        stderr, sys.stderr = sys.stderr, StringIO()
+        try:
+            self.assertRaises(SystemExit, cli.parse_args,
+                              ['-k', 'sample', '--checkpoint-every', '0'])
+        finally:
+            sys.stderr = stderr
+
+    def test_record(self):
+        import json
+        from py360link import BatchResult, Link360JSON
+        from py360link.cli import record
+        data = Link360JSON(sample_doc()).convert()
+        out = record(BatchResult(0, 'isbn=1', data=data,
+                                 resolved=Resolved(data)), 7)
+        self.assertEqual(out['line'], 7)
+        self.assertEqual(out['query'], 'isbn=1')
+        self.assertEqual(out['oclc_number'], '17803510')
+        self.assertEqual(out['error'], None)
+        self.assertTrue('rft.btitle=The+risk+pool' in out['openurl'])
+        json.dumps(out)
+        out = record(BatchResult(1, 'bad', error=IOError('refused')), 8)
+        self.assertEqual(out['data'], None)
+        self.assertEqual(out['openurl'], None)
+        self.assertEqual(out['error'], 'IOError: refused')
+
+class TestResolved(unittest.TestCase):
+    def setUp(self):
+        from py360link import Link360JSON
+        self.data = Link360JSON(sample_doc()).convert()
+        self.sersol = Resolved(self.data)
+
+    def test_memoized(self):
+        self.assertEqual(self.sersol.oclc_number, '17803510')
+        self.assertTrue(self.sersol.openurl is self.sersol.openurl)
+        pairs = self.sersol.openurl_pairs()
+        pairs.append(('extra', 'value'))
+        self.assertFalse(('extra', 'value') in self.sersol.openurl_pairs())
+        ourl_dict = urlparse.parse_qs(self.sersol.openurl)
+        self.assertEqual(ourl_dict['rft.btitle'], ['The risk pool'])
+        self.assertEqual(ourl_dict['sid'], ['FirstSearch:WorldCat'])
+
+    def test_all_results(self):
+        self.assertEqual(len(self.sersol.results), 2)
+        formats = [format for format, citation, groups in self.sersol.iter_results()]
+        self.assertEqual(formats, ['book', 'book'])
+        groups = list(self.sersol.iter_link_groups())
+        self.assertEqual(groups, self.data['results'][0]['linkGroups'])
+
+class TestOpenURLBuilder(unittest.TestCase):
+    def setUp(self):
+        from py360link import OpenURLBuilder
+        self.builder = OpenURLBuilder(memo_size=4)
+        self.citation = {
+            'title': 'Caf\xc3\xa9 & society',
+            'source': 'Journal of things',
+            'issn': {'print': '1234-5678'},
+            'isbn': ['1', '2'],
+            'doi': '10.1000/X',
+            'pmid': '123',
+            'creatorLast': u'M\xfcller',
+        }
+        self.retained = [('sid', ['a b']), ('rfe_dat', ['<x>'])]
+
+    def test_kev(self):
+        import urllib
+        for format in ('journal', 'book', 'unknown'):
+            pairs = self.builder.pairs(format, self.citation, self.retained)
+            expected = urllib.urlencode(pairs, doseq=True)
+            self.assertEqual(self.builder.encode(pairs), expected)
+            self.assertEqual(self.builder.kev(format, self.citation,
+                                              self.retained), expected)
+        pairs = self.builder.pairs('book', self.citation)
+        self.assertTrue(('rft.btitle', self.citation['title']) in pairs)
+        self.assertTrue(('rft_id', 'info:doi/10.1000/X') in pairs)
+        self.assertTrue(('rft.genre', 'book') in pairs)
+
+    def test_retained_from_query(self):
+        for query in ('sid=a&sid=b;rfe_dat=%3Cx%3E+1&x=1', 'rfe%5Fdat=1&sid=',
+                      'isbn=1&rfe_dat=%3Caccessionnumber%3E17803510'
+                      '%3C%2Faccessionnumber%3E&sid=FirstSearch%3AWorldCat', ''):
+            self.assertEqual(self.builder.retained_from_query(query),
+                             self.builder.retained(urlparse.parse_qs(query)))
+
+    def test_export(self):
+        from py360link import Link360JSON, export_coins, export_kev
+        data = Link360JSON(sample_doc()).convert()
+        class Custom(Resolved):
+            def openurl_pairs(self):
+                return [('custom', '1')]
+        records = [data, Resolved(data), Custom(data)]
+        openurl = Resolved(data).openurl
+        self.assertEqual(export_kev(records), [openurl, openurl, 'custom=1'])
+        span = export_coins([data])[0]
+        self.assertTrue(span.startswith('<span class="Z3988" title="ctx_ver='))
+        self.assertTrue('&amp;rft.' in span)
+        self.assertFalse('&rft.' in span)
+
+class TestCompactModel(unittest.TestCase):
+    def setUp(self):
+        from py360link import Link360JSON, compact
+        self.data = Link360JSON(sample_doc()).convert()
+        self.compact = compact(self.data)
+
+    def test_round_trip(self):
+        self.assertEqual(self.compact.to_dict(), self.data)
+        self.assertEqual(self.compact, self.data)
+
+    def test_mapping_access(self):
+        result = self.compact['results'][0]
+        self.assertEqual(result['citation']['isbn'], ['9780394565279'])
+        self.assertFalse('creatorFirst' in result['citation'])
+        holding = result['linkGroups'][0]['holdingData']
+        self.assertTrue(holding.has_key('providerId'))
+        self.assertFalse('endDate' in holding)
+        self.assertRaises(AttributeError, setattr, holding, 'other', 1)
+
+    def test_resolved(self):
+        expected = Resolved(self.data)
+        resolved = Resolved(self.compact)
+        self.assertEqual(resolved.citation['title'], 'The risk pool')
+        self.assertEqual(sorted(resolved.openurl_pairs()),
+                         sorted(expected.openurl_pairs()))
+
+    def test_shared_strings(self):
+        from py360link import Link360JSON, compact
+        other = compact(Link360JSON(sample_doc()).convert())
+        names = [c['results'][0]['linkGroups'][0]['holdingData']['providerName']
+                 for c in (self.compact, other)]
+        self.assertTrue(names[0] is names[1])
+
+class TestMetrics(unittest.TestCase):
+    def test_lookup_trace(self):
+        from py360link import MetricsCollector, LRUCache
+        metrics = MetricsCollector()
+        cache = LRUCache()
+        client = SampleClient(fail=['bad'])
+        get_sersol_data('isbn=9780394565279', client=client, cache=cache,
+                        observer=metrics)
+        data = get_sersol_data('isbn=9780394565279', client=client,
+                               cache=cache, observer=metrics)
+        self.assertRaises(IOError, get_sersol_data, 'bad', client=client,
+                          observer=metrics)
+        Resolved(data, observer=metrics).openurl
+        summary = metrics.summary()
+        self.assertEqual(summary['calls'], 4)
+        self.assertEqual(summary['cache'], {'hit': 1, 'miss': 1})
+        self.assertEqual(summary['errors'], {'IOError': 1})
+        self.assertEqual(summary['results'], 4)
+        self.assertEqual(summary['stages']['convert']['count'], 1)
+        self.assertEqual(summary['stages']['openurl_pairs']['count'], 1)
+        self.assertEqual(summary['stages']['lookup_total']['count'], 3)
+
+class TestResilience(unittest.TestCase):
+    def flaky(self, failures, error):
+        calls = []
+        def fn():
+            calls.append(1)
+            if len(calls) <= failures:
+                raise error
+            return 'ok'
+        return fn, calls
+
+    def test_retry(self):
+        import socket
+        from py360link import RetryPolicy
+        policy = RetryPolicy(attempts=3, backoff=0)
+        fn, calls = self.flaky(2, socket.timeout('timed out'))
+        self.assertEqual(policy.call(fn), 'ok')
+        self.assertEqual(len(calls), 3)
+        fn, calls = self.flaky(3, socket.timeout('timed out'))
+        self.assertRaises(socket.timeout, policy.call, fn)
+
+    def test_no_retry_on_client_error(self):
+        import urllib2
+        from py360link import RetryPolicy
+        error = urllib2.HTTPError('http://example.com', 404, 'Not Found', {}, None)
+        fn, calls = self.flaky(1, error)
+        self.assertRaises(urllib2.HTTPError, RetryPolicy(backoff=0).call, fn)
+        self.assertEqual(len(calls), 1)
+
+    def test_circuit_breaker(self):
+        import socket
+        from py360link import CircuitBreaker, CircuitOpen
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0)
+        fn, calls = self.flaky(2, socket.error('refused'))
+        self.assertRaises(socket.error, breaker.call, fn)
+        self.assertRaises(socket.error, breaker.call, fn)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        #reset_timeout has passed, so a trial call goes through.
+        self.assertEqual(breaker.call(fn), 'ok')
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        breaker.reset_timeout = 60
+        fn, calls = self.flaky(2, socket.error('refused'))
+        self.assertRaises(socket.error, breaker.call, fn)
+        self.assertRaises(socket.error, breaker.call, fn)
+        self.assertRaises(CircuitOpen, breaker.call, fn)
+        self.assertEqual(len(calls), 2)
+
+    def test_fallback(self):
+        import socket
+        class DownClient(SampleClient):
+            def get_response(self, query):
+                raise socket.error('Unable to reach 360Link.')
+        fallback = lambda query, error: {'query': query}
+        data = get_sersol_data('isbn=1', client=DownClient(), fallback=fallback)
+        self.assertEqual(data, {'query': 'isbn=1'})
+        #A plain IOError isn't transient, so it's raised unless fallback_on
+        #says otherwise.
+        client = SampleClient(fail=['bad'])
+        self.assertRaises(IOError, get_sersol_data, 'bad', client=client,
+                          fallback=fallback)
+        data = get_sersol_data('bad', client=client, fallback=fallback,
+                               fallback_on=lambda error: True)
+        self.assertEqual(data, {'query': 'bad'})
+
+class TestRateLimiter(unittest.TestCase):
+    def test_priority(self):
+        import threading, time
+        from py360link import RateLimiter, BULK, INTERACTIVE
+        limiter = RateLimiter(max_concurrency=1)
+        limiter.acquire()
+        order = []
+        def wait(priority, name):
+            limiter.acquire(priority)
+            order.append(name)
+            limiter.release()
+        threads = [threading.Thread(target=wait, args=(BULK, 'bulk')),
+                   threading.Thread(target=wait, args=(INTERACTIVE, 'interactive'))]
+        for thread in threads:
+            thread.start()
+            while len(limiter._waiters) < threads.index(thread) + 1:
+                time.sleep(0.001)
+        limiter.release()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, ['interactive', 'bulk'])
+
+    def test_aimd(self):
+        import socket
+        from py360link import RateLimiter
+        limiter = RateLimiter(max_concurrency=8, latency_target=1.0, cooldown=0)
+        limiter.acquire()
+        limiter.release(0.1, socket.timeout('timed out'))
+        self.assertEqual(limiter.limit, 4)
+        limiter.acquire()
+        limiter.release(2.0)
+        self.assertEqual(limiter.limit, 2)
+        for i in range(10):
+            limiter.acquire()
+            limiter.release(0.1)
+        self.assertTrue(limiter.limit > 4)
+
+    def test_timeout(self):
+        from py360link import RateLimiter, Link360Timeout
+        limiter = RateLimiter(max_concurrency=1)
+        limiter.acquire()
+        self.assertRaises(Link360Timeout, limiter.acquire, timeout=0.01)
+        self.assertEqual(limiter._waiters, [])
+
+class TestHoldingsIndex(unittest.TestCase):
+    def setUp(self):
+        import os
+        from lxml import etree
+        from py360link import HoldingsIndex, Link360JSON
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'bench', 'fixtures', 'many_link_groups.xml')
+        self.data = Link360JSON(etree.parse(path)).convert()
+        self.index = HoldingsIndex(':memory:', 'sample')
+
+    def tearDown(self):
+        self.index.close()
+
+    def test_resolve(self):
+        self.assertEqual(sorted(self.index.add(self.data)),
+                         ['0021-9010', '1939-1854'])
+        query = 'rft.eissn=1939-1854&rft.date=1970&rft.spage=1&rft_id=info:doi/10.1/X'
+        data = self.index.resolve(query)
+        result = data['results'][0]
+        self.assertEqual(result['citation']['doi'], '10.1/X')
+        self.assertEqual(result['citation']['source'],
+                         self.data['results'][0]['citation']['source'])
+        self.assertTrue(0 < len(result['linkGroups']) <
+                        len(self.data['results'][0]['linkGroups']))
+        for group in result['linkGroups']:
+            self.assertTrue(set(group['url']) <= set(['journal', 'source']))
+        self.assertEqual(self.index.resolve('issn=0000-0000'), None)
+        self.assertEqual((self.index.hits, self.index.misses), (1, 1))
+
+    def test_max_age(self):
+        self.index.add(self.data)
+        self.index.max_age = -1
+        self.assertEqual(self.index.link_groups('0021-9010'), None)
+        self.assertEqual(self.index.purge(), 2)
+
+    def test_merge(self):
+        import copy, time
+        groups = self.data['results'][0]['linkGroups']
+        subset = copy.deepcopy(self.data)
+        subset['results'][0]['linkGroups'] = groups[:1]
+        self.index.add(self.data)
+        self.index.add(subset)
+        #A response with fewer groups doesn't drop the others.
+        self.assertEqual(len(self.index.link_groups('0021-9010')), len(groups))
+        #Groups not seen again age out on their own.
+        self.index.max_age = 0.05
+        time.sleep(0.1)
+        self.index.add(subset)
+        merged = self.index.link_groups('0021-9010')
+        self.assertEqual([g['holdingData'] for g in merged],
+                         [groups[0]['holdingData']])
+        self.assertEqual(self.index.purge(), 0)
+        count = self.index._conn.execute(
+            'SELECT COUNT(*) FROM journal_link_groups').fetchone()[0]
+        self.assertEqual(count, 2)
+
+class TestReprocess(unittest.TestCase):
+    def setUp(self):
+        import gzip, os, tarfile, tempfile
+        self.dir = tempfile.mkdtemp()
+        with open(os.path.join(self.dir, 'a.xml'), 'wb') as f:
+            f.write(SAMPLE_XML)
+        with open(os.path.join(self.dir, 'broken.xml'), 'wb') as f:
+            f.write('<not xml')
+        f = gzip.open(os.path.join(self.dir, 'b.xml.gz'), 'wb')
+        f.write(SAMPLE_XML)
+        f.close()
+        fixtures = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'bench', 'fixtures')
+        with tarfile.open(os.path.join(self.dir, 'c.tar.gz'), 'w:gz') as tar:
+            tar.add(os.path.join(fixtures, 'single.xml'), 'single.xml')
+            tar.add(os.path.join(fixtures, 'diagnostics.xml'), 'diagnostics.xml')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dir)
+
+    def test_reprocess(self):
+        import json
+        from py360link import Link360JSON, iter_reprocess, iter_sources
+        results = list(iter_reprocess(iter_sources([self.dir]), processes=2,
+                                      chunk_size=2))
+        names = [r.source[len(self.dir) + 1:] for r in results]
+        self.assertEqual(names, ['a.xml', 'b.xml.gz', 'broken.xml',
+                                 'c.tar.gz:single.xml',
+                                 'c.tar.gz:diagnostics.xml'])
+        self.assertEqual([r.ok for r in results],
+                         [True, True, False, True, False])
+        self.assertTrue(results[2].error.startswith('XMLSyntaxError'))
+        record = results[0].record
+        self.assertEqual(record['data'],
+                         json.loads(json.dumps(Link360JSON(sample_doc()).convert())))
+        self.assertTrue('rfe_dat=' in record['openurl'])
+        self.assertEqual(record['oclc_number'], '17803510')
+        #Diagnostics are converted but can't be resolved.
+        self.assertTrue('diagnostics' in results[4].record['data'])
+        unordered = iter_reprocess(iter_sources([self.dir]), processes=2,
+                                   chunk_size=1, ordered=False)
+        self.assertEqual(sorted(r.source for r in unordered),
+                         sorted(r.source for r in results))
+
+    def test_unreadable(self):
+        import os
+        from py360link import iter_reprocess, iter_sources
+        paths = [os.path.join(self.dir, name) for name in
+                 ('corrupt.xml.gz', 'bad.tar.gz', 'a.xml', 'missing.xml')]
+        for path in paths[:2]:
+            with open(path, 'wb') as f:
+                f.write(SAMPLE_XML)
+        for ordered in (True, False):
+            results = list(iter_reprocess(iter_sources(paths), processes=2,
+                                          chunk_size=1, ordered=ordered))
+            results.sort(key=lambda r: paths.index(r.source))
+            self.assertEqual([r.source for r in results], paths)
+            self.assertEqual([r.ok for r in results], [False, False, True, False])
+            self.assertTrue(results[0].error.startswith('IOError'))
+            self.assertTrue(results[1].error.startswith('ReadError'))
+            self.assertTrue(results[3].error.startswith('IOError'))
+
 if __name__ == '__main__':
     unittest.main()
     